@@ -0,0 +1,414 @@
+import asyncio
+import hashlib
+import logging
+import time
+from collections import Counter, deque
+from contextlib import aclosing
+
+import httpx
+from ollama import AsyncClient, ResponseError
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class BackendUnavailable(Exception):
+    pass
+
+
+def is_host_failure(error):
+    # Errors that say something about the host rather than the request
+    if isinstance(error, ResponseError):
+        return error.status_code >= 500
+    return isinstance(error, (ConnectionError, httpx.TransportError))
+
+
+def percentile(samples, fraction):
+    ordered = sorted(samples)
+    return ordered[min(int(len(ordered) * fraction), len(ordered) - 1)]
+
+
+def succeeded(task):
+    return task.done() and not task.cancelled() and task.exception() is None
+
+
+class CircuitBreaker:
+    """Closed -> open -> half-open circuit breaker for one host.
+
+    The circuit opens after ``consecutive`` failures in a row, or when at
+    least ``min_requests`` of the last ``window`` outcomes are known and
+    ``error_rate`` of them are failures. After ``open_time`` seconds it is
+    half-open and lets a single trial request through: success closes it,
+    failure opens it again. ``on_transition(old, new)`` is called for every
+    state change.
+    """
+
+    def __init__(self, window=20, min_requests=5, error_rate=0.5, consecutive=3, open_time=30.0,
+                 on_transition=None):
+        self.min_requests = min_requests
+        self.error_rate = error_rate
+        self.consecutive = consecutive
+        self.open_time = open_time
+        self.on_transition = on_transition
+        self.outcomes = deque(maxlen=window)  # True for failures
+        self.failures = 0  # Consecutive failures
+        self.opened_at = 0.0
+        self.trial = False
+        self._state = CLOSED
+
+    def _move(self, state):
+        old, self._state = self._state, state
+        if self.on_transition is not None and old != state:
+            self.on_transition(old, state)
+
+    @property
+    def state(self):
+        if self._state == OPEN and time.monotonic() - self.opened_at >= self.open_time:
+            self.trial = False
+            self._move(HALF_OPEN)
+        return self._state
+
+    @property
+    def available(self):
+        state = self.state
+        return state == CLOSED or (state == HALF_OPEN and not self.trial)
+
+    def acquire(self):
+        # Called as a request goes out; takes the half-open trial
+        if self.state == HALF_OPEN:
+            self.trial = True
+
+    def release(self):
+        # For requests that ended without saying anything about the host
+        self.trial = False
+
+    def success(self):
+        self.outcomes.append(False)
+        self.failures = 0
+        self.trial = False
+        if self._state != CLOSED:
+            self.outcomes.clear()
+            self._move(CLOSED)
+
+    def failure(self):
+        self.outcomes.append(True)
+        self.failures += 1
+        self.trial = False
+        if self._state == CLOSED and self.failures < self.consecutive:
+            if len(self.outcomes) < self.min_requests or sum(self.outcomes) < self.error_rate * len(self.outcomes):
+                return
+        self.opened_at = time.monotonic()
+        self._move(OPEN)
+
+
+class Backend:
+    """One Ollama host with its own client, concurrency cap and breaker."""
+
+    def __init__(self, host, breaker, max_inflight=4, alpha=0.3, **client_args):
+        self.host = host
+        self.client = AsyncClient(host=host, **client_args)
+        self.breaker = breaker
+        self.max_inflight = max_inflight
+        self.alpha = alpha
+        self.outstanding = 0
+        self.latency = None  # EWMA of seconds until the first response bytes
+        self.requests = 0
+        self.slots = asyncio.Semaphore(max_inflight)
+
+    @property
+    def free(self):
+        return self.outstanding < self.max_inflight
+
+    def observe(self, seconds):
+        if self.latency is None:
+            self.latency = seconds
+        else:
+            self.latency += self.alpha * (seconds - self.latency)
+
+    def stats(self):
+        return {
+            "state": self.breaker.state,
+            "outstanding": self.outstanding,
+            "latency": self.latency,
+            "requests": self.requests,
+            "failures": self.breaker.failures,
+        }
+
+
+class BackendPool:
+    """Spreads Ollama requests over several hosts.
+
+    Offers the ``chat`` and ``embed`` calls of :class:`ollama.AsyncClient`,
+    plus an optional ``user`` argument. Requests for a user go to the same
+    host (rendezvous hashing) while it is available and has a free slot, so
+    its prompt cache stays warm; otherwise they go to the host with the
+    fewest outstanding requests (``routing="least"``) or the lowest
+    ``latency * (outstanding + 1)`` (``routing="ewma"``).
+
+    Every host has a :class:`CircuitBreaker`. When every circuit is open,
+    requests fail at once with :class:`BackendUnavailable`. :meth:`probe`
+    checks every host and doubles as the half-open trial.
+
+    With ``hedge`` on, a chat request that has had no response after the
+    p95 of recent response times (but at least ``hedge_min_delay``) is sent
+    again: to another host with a free slot or, failing that, as a request
+    for ``hedge_model``. The first answer wins and the other request is
+    cancelled. For streams this goes by the first chunk.
+
+    Breaker transitions, hedges and rejected requests are counted in
+    :attr:`metrics`.
+    """
+
+    def __init__(self, hosts, max_inflight=4, host_limits=None, routing="least", eject_after=3,
+                 eject_time=30.0, error_rate=0.5, error_window=20, probe_timeout=5.0, hedge=True,
+                 hedge_min_delay=1.0, hedge_samples=20, **client_args):
+        host_limits = host_limits or {}
+        self.metrics = Counter()
+        self.backends = []
+        for host in hosts:
+            breaker = CircuitBreaker(
+                window=error_window, error_rate=error_rate, consecutive=eject_after,
+                open_time=eject_time, on_transition=self._transition_logger(host)
+            )
+            self.backends.append(
+                Backend(host, breaker, max_inflight=host_limits.get(host, max_inflight), **client_args)
+            )
+        self.routing = routing
+        self.probe_timeout = probe_timeout
+        self.hedge = hedge
+        self.hedge_min_delay = hedge_min_delay
+        self.hedge_samples = hedge_samples
+        self.latencies = {"chat": deque(maxlen=200), "stream": deque(maxlen=200)}
+
+    def _transition_logger(self, host):
+        def on_transition(old, new):
+            self.metrics[f"breaker.{old}->{new}"] += 1
+            level = logging.WARNING if new == OPEN else logging.INFO
+            logging.log(level, f"Ollama host {host} circuit {old} -> {new}")
+        return on_transition
+
+    def _load(self, backend):
+        if self.routing == "ewma":
+            return (backend.latency or 0.0) * (backend.outstanding + 1), backend.outstanding
+        return backend.outstanding, backend.latency or 0.0
+
+    def pick(self, user=None, exclude=None):
+        candidates = [b for b in self.backends if b is not exclude and b.breaker.available]
+        if not candidates:
+            return None
+        if user is not None:
+            home = max(candidates, key=lambda backend: hashlib.blake2b(
+                f"{user}@{backend.host}".encode(), digest_size=8).digest())
+            if home.free:
+                return home
+        return min(candidates, key=self._load)
+
+    def _pick(self, user=None):
+        backend = self.pick(user)
+        if backend is None:
+            self.metrics["rejected"] += 1
+            raise BackendUnavailable("No Ollama host is available")
+        return backend
+
+    def _hedge_delay(self, kind):
+        samples = self.latencies[kind]
+        if not self.hedge or len(samples) < self.hedge_samples:
+            return None
+        return max(percentile(samples, 0.95), self.hedge_min_delay)
+
+    def _hedge_target(self, primary, kwargs, hedge_model):
+        # Another host first, the smaller model only as a fallback
+        backend = self.pick(exclude=primary)
+        if backend is not None and backend.free:
+            return backend, kwargs
+        if hedge_model and hedge_model != kwargs.get("model"):
+            backend = self.pick()
+            if backend is not None and backend.free:
+                return backend, dict(kwargs, model=hedge_model)
+        return None, None
+
+    async def _call(self, backend, method, kwargs, timed=True):
+        backend.outstanding += 1
+        backend.requests += 1
+        backend.breaker.acquire()
+        try:
+            async with backend.slots:
+                started = time.monotonic()
+                response = await getattr(backend.client, method)(**kwargs)
+                elapsed = time.monotonic() - started
+        except Exception as e:
+            if is_host_failure(e):
+                backend.breaker.failure()
+            else:
+                backend.breaker.release()
+            raise
+        except BaseException:
+            backend.breaker.release()
+            raise
+        finally:
+            backend.outstanding -= 1
+        if timed:
+            backend.observe(elapsed)
+            if method == "chat":
+                self.latencies["chat"].append(elapsed)
+        backend.breaker.success()
+        return response
+
+    async def _stream(self, backend, kwargs):
+        # The slot is only taken once the caller starts iterating, so a
+        # stream that is never iterated holds nothing
+        backend.outstanding += 1
+        backend.requests += 1
+        backend.breaker.acquire()
+        try:
+            async with backend.slots:
+                started = time.monotonic()
+                stream = await backend.client.chat(**kwargs)
+                async with aclosing(stream):
+                    async for part in stream:
+                        if started is not None:
+                            elapsed = time.monotonic() - started
+                            backend.observe(elapsed)
+                            self.latencies["stream"].append(elapsed)
+                            started = None
+                        yield part
+        except Exception as e:
+            if is_host_failure(e):
+                backend.breaker.failure()
+            else:
+                backend.breaker.release()
+            raise
+        except BaseException:
+            backend.breaker.release()
+            raise
+        finally:
+            backend.outstanding -= 1
+        backend.breaker.success()
+
+    async def _race(self, primary, delay, start_hedge):
+        # Returns (winner, loser); loser is None when no hedge was sent
+        done, _ = await asyncio.wait({primary}, timeout=delay)
+        hedge = None if done else start_hedge()
+        if hedge is None:
+            await asyncio.wait({primary})
+            return primary, None
+        self.metrics["hedge.sent"] += 1
+
+        # A failed request only loses while the other one can still answer
+        pending = {primary, hedge}
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            winner = next((task for task in done if succeeded(task)), next(iter(done)))
+            if succeeded(winner):
+                break
+        if winner is hedge:
+            self.metrics["hedge.won"] += 1
+        return winner, hedge if winner is primary else primary
+
+    @staticmethod
+    async def _discard(task, stream=None):
+        task.cancel()
+        await asyncio.wait({task})
+        if not task.cancelled():
+            task.exception()
+        if stream is not None:
+            await stream.aclose()
+
+    async def _hedged_call(self, user, kwargs, hedge_model):
+        backend = self._pick(user)
+        primary = asyncio.ensure_future(self._call(backend, "chat", kwargs))
+        tasks = [primary]
+
+        def start_hedge():
+            target, hedge_kwargs = self._hedge_target(backend, kwargs, hedge_model)
+            if target is None:
+                return None
+            tasks.append(asyncio.ensure_future(self._call(target, "chat", hedge_kwargs)))
+            return tasks[-1]
+
+        try:
+            winner, loser = await self._race(primary, self._hedge_delay("chat"), start_hedge)
+        except BaseException:
+            for task in tasks:
+                task.cancel()
+            raise
+        if loser is not None:
+            await self._discard(loser)
+        return winner.result()
+
+    async def _hedged_stream(self, user, kwargs, hedge_model):
+        backend = self._pick(user)
+        streams = {}  # first-chunk task -> its stream
+
+        def first_part(target, target_kwargs):
+            stream = self._stream(target, target_kwargs)
+            task = asyncio.ensure_future(anext(stream))
+            streams[task] = stream
+            return task
+
+        def start_hedge():
+            target, hedge_kwargs = self._hedge_target(backend, kwargs, hedge_model)
+            return first_part(target, hedge_kwargs) if target is not None else None
+
+        primary = first_part(backend, kwargs)
+        try:
+            winner, loser = await self._race(primary, self._hedge_delay("stream"), start_hedge)
+        except BaseException:
+            for task, stream in streams.items():
+                await self._discard(task, stream)
+            raise
+        if loser is not None:
+            await self._discard(loser, streams[loser])
+
+        stream = streams[winner]
+        async with aclosing(stream):
+            try:
+                yield winner.result()
+            except StopAsyncIteration:
+                return
+            async for part in stream:
+                yield part
+
+    async def chat(self, user=None, hedge_model=None, **kwargs):
+        if kwargs.get("stream"):
+            return self._hedged_stream(user, kwargs, hedge_model)
+        return await self._hedged_call(user, kwargs, hedge_model)
+
+    async def embed(self, user=None, **kwargs):
+        return await self._call(self._pick(user), "embed", kwargs)
+
+    async def call_host(self, host, method, **kwargs):
+        # A request for one particular host, like loading a model there.
+        # It takes a slot like any other but doesn't count towards latency
+        backend = next(backend for backend in self.backends if backend.host == host)
+        if not backend.breaker.available:
+            raise BackendUnavailable(f"Ollama host {host} is unavailable")
+        return await self._call(backend, method, kwargs, timed=False)
+
+    async def probe(self, context=None):
+        # Health check every host; for a half-open one this is the trial
+        async def check(backend):
+            breaker = backend.breaker
+            if not breaker.available:
+                return
+            breaker.acquire()
+            try:
+                await asyncio.wait_for(backend.client.ps(), self.probe_timeout)
+            except Exception:
+                breaker.failure()
+            else:
+                breaker.success()
+        await asyncio.gather(*(check(backend) for backend in self.backends))
+
+    def stats(self):
+        stats = {backend.host: backend.stats() for backend in self.backends}
+        for kind, samples in self.latencies.items():
+            if samples:
+                stats[f"{kind}.p95"] = percentile(samples, 0.95)
+        stats.update(self.metrics)
+        return stats
+
+    async def close(self):
+        for backend in self.backends:
+            await backend.client._client.aclose()
@@ -0,0 +1,78 @@
+"""Per-chat wait times through LLMDispatcher under a skewed load.
+
+``--requests`` jobs of ``--job-time`` seconds arrive as a Poisson process
+at ``--load`` times what ``--workers`` workers can serve. ``--busy-share``
+of them come from one busy group chat and the rest from ``--small-chats``
+other chats. Wait times are reported per chat for the fair queue and, for
+comparison, for a plain first-come-first-served queue.
+
+    python bench_dispatch.py --workers 4 --job-time 0.01 --requests 600 --busy-share 0.8
+"""
+import argparse
+import asyncio
+import random
+import time
+from collections import defaultdict
+
+from dispatch import LLMDispatcher
+
+
+def percentile(samples, fraction):
+    ordered = sorted(samples)
+    return ordered[min(int(len(ordered) * fraction), len(ordered) - 1)]
+
+
+async def run(fair, args):
+    dispatcher = LLMDispatcher(workers=args.workers, max_queue=args.requests)
+    dispatcher.start()
+    rng = random.Random(args.seed)
+    rate = args.load * args.workers / args.job_time
+    waits = defaultdict(list)  # chat -> seconds from arrival to finish
+
+    async def job():
+        await asyncio.sleep(args.job_time)
+
+    async def request(chat_id, user_id):
+        started = time.monotonic()
+        # FIFO is the fair queue with everything in one chat and user
+        future, _ = dispatcher.submit(chat_id, user_id, job) if fair else dispatcher.submit("all", "all", job)
+        await future
+        waits[chat_id].append(time.monotonic() - started)
+
+    requests = []
+    for _ in range(args.requests):
+        await asyncio.sleep(rng.expovariate(rate))
+        if rng.random() < args.busy_share:
+            chat_id, user_id = "busy", rng.randrange(args.busy_users)
+        else:
+            chat_id = f"small{rng.randrange(args.small_chats)}"
+            user_id = chat_id
+        requests.append(asyncio.ensure_future(request(chat_id, user_id)))
+    await asyncio.gather(*requests)
+    await dispatcher.stop()
+    return waits
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--job-time", type=float, default=0.01)
+    parser.add_argument("--requests", type=int, default=600)
+    parser.add_argument("--load", type=float, default=1.5, help="arrival rate as a multiple of capacity")
+    parser.add_argument("--busy-share", type=float, default=0.8)
+    parser.add_argument("--busy-users", type=int, default=20)
+    parser.add_argument("--small-chats", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    for name, fair in (("fifo", False), ("fair", True)):
+        waits = asyncio.run(run(fair, args))
+        print(f"\n{name}: {'chat':>8}{'jobs':>6}{'p50':>9}{'p99':>9}")
+        for chat_id in sorted(waits, key=lambda chat_id: (chat_id != "busy", chat_id)):
+            samples = waits[chat_id]
+            print(f"{'':6}{chat_id:>8}{len(samples):>6}"
+                  f"{percentile(samples, 0.5) * 1000:>7.0f}ms{percentile(samples, 0.99) * 1000:>7.0f}ms")
+
+
+if __name__ == "__main__":
+    main()
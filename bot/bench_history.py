@@ -0,0 +1,104 @@
+"""History lookup latency against the size of the conversation table.
+
+Fills a scratch conversations database with ``--rows`` rows spread over
+``--users`` users, applies the (user_id, id DESC) index migration and times
+the newest-turns query get_recent_turns runs. The old unindexed
+``ORDER BY timestamp`` query is timed for comparison on the first size.
+
+    python bench_history.py --rows 1000000,10000000
+"""
+import argparse
+import os
+import random
+import sqlite3
+import tempfile
+import time
+
+from storage import migrate
+
+# As in tbot.py
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS conversation (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id TEXT,
+    user_message TEXT,
+    bot_response TEXT,
+    timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
+)
+"""
+INDEX = "CREATE INDEX IF NOT EXISTS idx_conversation_user_id ON conversation (user_id, id DESC)"
+LOOKUP = """
+    SELECT id, user_message, bot_response FROM conversation
+    WHERE user_id = ?
+    ORDER BY id DESC
+    LIMIT ?
+"""
+OLD_LOOKUP = """
+    SELECT user_message, bot_response FROM conversation
+    WHERE user_id = ?
+    ORDER BY timestamp DESC
+    LIMIT ?
+"""
+
+
+def percentile(samples, fraction):
+    ordered = sorted(samples)
+    return ordered[min(int(len(ordered) * fraction), len(ordered) - 1)]
+
+
+def fill(db, rows, users, rng):
+    db.execute(SCHEMA)
+    batch = 100000
+    for start in range(0, rows, batch):
+        with db:
+            db.executemany(
+                "INSERT INTO conversation (user_id, user_message, bot_response) VALUES (?, ?, ?)",
+                ((str(rng.randrange(users)), f"message {n}", f"reply to message {n}")
+                 for n in range(start, min(start + batch, rows)))
+            )
+
+
+def time_lookups(db, query, count, users, limit, rng):
+    samples = []
+    for _ in range(count):
+        user_id = str(rng.randrange(users))
+        started = time.perf_counter()
+        db.execute(query, (user_id, limit)).fetchall()
+        samples.append(time.perf_counter() - started)
+    return samples
+
+
+def report(name, samples):
+    print(f"{name:30}p50 {percentile(samples, 0.5) * 1000:9.3f} ms   p99 {percentile(samples, 0.99) * 1000:9.3f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", default="1000000,10000000", help="table sizes to try")
+    parser.add_argument("--users", type=int, default=10000)
+    parser.add_argument("--limit", type=int, default=20, help="turns per lookup (HISTORY_TURNS)")
+    parser.add_argument("--lookups", type=int, default=2000)
+    parser.add_argument("--old-lookups", type=int, default=20, help="unindexed lookups on the first size (0 = skip)")
+    parser.add_argument("--dir", help="where to put the databases (default: a scratch directory)")
+    args = parser.parse_args()
+
+    directory = args.dir or tempfile.mkdtemp(prefix="kisaragi-bench-")
+    rng = random.Random(1)
+    for index, rows in enumerate(int(rows) for rows in args.rows.split(",")):
+        path = os.path.join(directory, f"conversations-{rows}.sqlite3")
+        db = sqlite3.connect(path)
+        try:
+            started = time.monotonic()
+            fill(db, rows, args.users, rng)
+            print(f"\n{rows:,} rows over {args.users:,} users (filled in {time.monotonic() - started:.0f}s)")
+            if index == 0 and args.old_lookups:
+                report("before (timestamp, no index)", time_lookups(db, OLD_LOOKUP, args.old_lookups, args.users, args.limit, rng))
+            migrate(db, [INDEX])
+            report("after (user_id, id DESC)", time_lookups(db, LOOKUP, args.lookups, args.users, args.limit, rng))
+        finally:
+            db.close()
+            os.remove(path)
+
+
+if __name__ == "__main__":
+    main()
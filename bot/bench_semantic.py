@@ -0,0 +1,95 @@
+"""Semantic cache lookup time and what it costs the event loop.
+
+Fills a scratch SemanticCache with ``--entries`` random unit vectors of
+``--dim`` dimensions (all-minilm has 384) and times ``--lookups`` lookups
+while a task measures event-loop lag. "inline" scores the matrix on the
+event loop, as lookups used to; "executor" is SemanticCache.lookup.
+
+    python bench_semantic.py --entries 100000 --dim 384
+"""
+import argparse
+import asyncio
+import os
+import tempfile
+import time
+
+import numpy as np
+
+from semantic_cache import SEMANTIC_CACHE_SCHEMA, SemanticCache
+from storage import Database
+
+
+def percentile(samples, fraction):
+    ordered = sorted(samples)
+    return ordered[min(int(len(ordered) * fraction), len(ordered) - 1)]
+
+
+def unit_vectors(rng, count, dim):
+    vectors = rng.standard_normal((count, dim), dtype=np.float32)
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+async def run(cache, queries, inline):
+    lag = []
+
+    async def monitor(interval=0.001):
+        while True:
+            started = time.monotonic()
+            await asyncio.sleep(interval)
+            lag.append(time.monotonic() - started - interval)
+
+    job = asyncio.ensure_future(monitor())
+    await asyncio.sleep(0.01)
+    lookups = []
+    for vector in queries:
+        started = time.monotonic()
+        if inline:
+            SemanticCache._best(cache._matrix, cache._filled, vector)
+        else:
+            await cache.lookup(vector, "model")
+        lookups.append(time.monotonic() - started)
+        await asyncio.sleep(0)
+    job.cancel()
+    return lookups, lag
+
+
+async def fill(cache, rng, args):
+    for start in range(0, args.entries, 10000):
+        for vector in unit_vectors(rng, min(10000, args.entries - start), args.dim):
+            cache.add(vector, "model", "reply")
+        await asyncio.sleep(0)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--entries", type=int, default=100000)
+    parser.add_argument("--dim", type=int, default=384)
+    parser.add_argument("--lookups", type=int, default=500)
+    parser.add_argument("--dir", help="where to put the cache (default: a scratch directory)")
+    args = parser.parse_args()
+
+    directory = args.dir or tempfile.mkdtemp(prefix="kisaragi-bench-")
+    db_path = os.path.join(directory, "semantic.sqlite3")
+    cache_path = os.path.join(directory, "semantic_cache.npy")
+    db = Database(db_path, schema=[SEMANTIC_CACHE_SCHEMA])
+    cache = SemanticCache(None, db, cache_path, capacity=args.entries)
+    rng = np.random.default_rng(1)
+    try:
+        asyncio.run(fill(cache, rng, args))
+        queries = unit_vectors(rng, args.lookups, args.dim)
+        print(f"{args.entries:,} entries x {args.dim}")
+        print(f"{'':10}{'lookup p50':>12}{'lookup p95':>12}{'loop lag p99':>14}{'max':>9}")
+        for name, inline in (("inline", True), ("executor", False)):
+            lookups, lag = asyncio.run(run(cache, queries, inline))
+            print(f"{name:10}{percentile(lookups, 0.5) * 1000:>10.1f}ms{percentile(lookups, 0.95) * 1000:>10.1f}ms"
+                  f"{percentile(lag, 0.99) * 1000:>12.1f}ms{max(lag) * 1000:>7.1f}ms")
+    finally:
+        db.close()
+        del cache
+        for path in (cache_path, db_path, db_path + "-wal", db_path + "-shm"):
+            if os.path.exists(path):
+                os.remove(path)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,74 @@
+"""Talk latency under overload, with and without load shedding.
+
+Runs loadtest.py twice with users arriving as a Poisson process at
+``--overload`` times what the LLM workers can serve, for ``--seconds``
+seconds; each user sends one message, never the same one twice, so
+the caches don't take the load off the model. Capacity is taken from the stub:
+LLM_WORKERS turns of first_token_delay + reply_tokens / tokens_per_sec
+seconds each. "off" raises every SHED_* threshold out of reach, so
+turns only fail once the LLM queue is full; "on" uses the bot's
+defaults, with FAST_MODEL served ``--fast-speedup`` times faster.
+
+    python bench_shedding.py --overload 5 --seconds 30 --workers 2
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+
+BOT_DIR = os.path.dirname(os.path.abspath(__file__))
+FAST_MODEL = "llama3.2:1b"
+OUT_OF_REACH = "1000000,1000000,1000000"
+
+
+def run(name, args, env):
+    path = os.path.join(tempfile.mkdtemp(prefix="kisaragi-bench-"), f"{name}.json")
+    turn_time = args.first_token_delay + args.reply_tokens / args.tokens_per_sec
+    rate = args.overload * args.workers / turn_time
+    command = [
+        sys.executable, os.path.join(BOT_DIR, "loadtest.py"),
+        "--users", str(round(rate * args.seconds)), "--messages", "1", "--arrival-rate", str(rate),
+        "--unique-prompts",
+        "--stubs", "1", "--max-concurrency", str(args.workers),
+        "--tokens-per-sec", str(args.tokens_per_sec), "--first-token-delay", str(args.first_token_delay),
+        "--reply-tokens", str(args.reply_tokens),
+        "--model-speeds", f"{FAST_MODEL}={args.tokens_per_sec * args.fast_speedup}",
+        "--seed", str(args.seed), "--rank-interval", "0", "--json", path,
+        "--env", f"LLM_WORKERS={args.workers}", "--env", f"FAST_MODEL={FAST_MODEL}",
+        *(f"--env={setting}" for setting in env),
+    ]
+    subprocess.run(command, check=True, stdout=None if args.verbose else subprocess.DEVNULL)
+    with open(path) as f:
+        return json.load(f)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--overload", type=float, default=5.0, help="arrival rate as a multiple of capacity")
+    parser.add_argument("--seconds", type=float, default=30.0, help="how long users keep arriving")
+    parser.add_argument("--workers", type=int, default=2, help="LLM_WORKERS")
+    parser.add_argument("--tokens-per-sec", type=float, default=75.0)
+    parser.add_argument("--first-token-delay", type=float, default=0.2)
+    parser.add_argument("--reply-tokens", type=int, default=120)
+    parser.add_argument("--fast-speedup", type=float, default=2.0)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--verbose", action="store_true", help="show loadtest.py's own report")
+    args = parser.parse_args()
+
+    runs = {
+        "off": [f"SHED_QUEUE_DEPTHS={OUT_OF_REACH}", f"SHED_LATENCIES={OUT_OF_REACH}"],
+        "on": [],
+    }
+    print(f"{'shedding':10}{'turns':>6}{'p50':>9}{'p95':>9}{'p99':>9}  outcomes / admission")
+    for name, env in runs.items():
+        results = run(name, args, env)
+        latency = results["latency"]["full reply"]
+        print(f"{name:10}{results['turns']:>6}"
+              + "".join(f"{latency[f]:>8.1f}s" for f in ("p50", "p95", "p99"))
+              + f"  {results['outcomes']} / {results['admission']}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,93 @@
+"""Commit throughput and leaderboard read latency, default vs tuned pragmas.
+
+For each pragma set, a scratch ranks database with ``--rows`` users runs
+single-row XP upserts back to back through :class:`storage.Database` for
+``--seconds`` seconds while ``--readers`` tasks keep reading the top 10.
+"default" is SQLite's own configuration (rollback journal, synchronous=FULL,
+no memory map, 2 MB cache); "tuned" is storage.DEFAULT_PRAGMAS.
+
+    python bench_sqlite.py --rows 50000 --seconds 10
+"""
+import argparse
+import asyncio
+import os
+import random
+import tempfile
+import time
+
+from storage import DEFAULT_PRAGMAS, Database
+
+SQLITE_DEFAULTS = {"journal_mode": "DELETE", "synchronous": "FULL", "mmap_size": 0, "cache_size": -2000}
+
+# user_ranks as in tbot.py, without the leaderboard index so the reads
+# do real work
+SCHEMA = ["""
+CREATE TABLE IF NOT EXISTS user_ranks (
+    user_id TEXT PRIMARY KEY,
+    username TEXT,
+    xp INTEGER DEFAULT 0,
+    level INTEGER DEFAULT 1
+)
+"""]
+UPSERT = """
+    INSERT INTO user_ranks (user_id, username, xp, level) VALUES (?, ?, ?, 1)
+    ON CONFLICT(user_id) DO UPDATE SET xp = xp + excluded.xp
+"""
+TOP = "SELECT username, level, xp FROM user_ranks ORDER BY level DESC, xp DESC LIMIT 10"
+
+
+def percentile(samples, fraction):
+    ordered = sorted(samples)
+    return ordered[min(int(len(ordered) * fraction), len(ordered) - 1)]
+
+
+async def run(pragmas, args, directory):
+    path = os.path.join(directory, "ranks.sqlite3")
+    db = Database(path, schema=SCHEMA, pragmas=pragmas)
+    rng = random.Random(1)
+    try:
+        await db.executemany(UPSERT, ((str(n), f"user{n}", rng.randrange(100)) for n in range(args.rows)))
+        deadline = time.monotonic() + args.seconds
+        commits = 0
+        reads = []
+
+        async def writer():
+            nonlocal commits
+            while time.monotonic() < deadline:
+                user_id = str(rng.randrange(args.rows))
+                await db.execute(UPSERT, (user_id, f"user{user_id}", 1))
+                commits += 1
+
+        async def reader():
+            while time.monotonic() < deadline:
+                started = time.monotonic()
+                await db.fetchall(TOP)
+                reads.append(time.monotonic() - started)
+
+        await asyncio.gather(writer(), *(reader() for _ in range(args.readers)))
+        return commits / args.seconds, reads
+    finally:
+        db.close()
+        for suffix in ("", "-wal", "-shm", "-journal"):
+            if os.path.exists(path + suffix):
+                os.remove(path + suffix)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=50000)
+    parser.add_argument("--seconds", type=float, default=10.0)
+    parser.add_argument("--readers", type=int, default=1)
+    parser.add_argument("--dir", help="where to put the database (default: a scratch directory)")
+    args = parser.parse_args()
+
+    directory = args.dir or tempfile.mkdtemp(prefix="kisaragi-bench-")
+    print(f"{'':8}{'commits/s':>10}{'reads':>7}{'read p50':>11}{'read p99':>11}")
+    for name, pragmas in (("default", SQLITE_DEFAULTS), ("tuned", DEFAULT_PRAGMAS)):
+        throughput, reads = asyncio.run(run(pragmas, args, directory))
+        print(f"{name:8}{throughput:>10.0f}{len(reads):>7}"
+              f"{percentile(reads, 0.5) * 1000:>9.1f}ms{percentile(reads, 0.99) * 1000:>9.1f}ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,96 @@
+"""Update throughput of PerUserUpdateProcessor at several concurrency limits.
+
+Each of ``--users`` users sends ``--updates`` updates at once; every
+handler waits ``--handler-time`` seconds, like a handler that makes one
+Telegram API call. Per-user ordering is checked along the way.
+
+Interleaved arrivals hide one user's backlog, so a second case has one
+user send more than ``limit`` updates of ``--slow-time`` seconds and
+another user send one more right after; that user's wait should be about
+``--handler-time``, not stuck behind the backlog.
+
+    python bench_updates.py --users 50 --updates 20 --limits 1,4,16,64
+"""
+import argparse
+import asyncio
+import datetime
+import time
+from contextlib import suppress
+
+from telegram import Chat, Message, Update, User
+from telegram.constants import ChatType
+
+from update_processor import PerUserUpdateProcessor
+
+
+async def run(limit, args):
+    processor = PerUserUpdateProcessor(limit)
+    seen = {}  # user_id -> sequence numbers in handling order
+
+    async def handler(user_id, number):
+        await asyncio.sleep(args.handler_time)
+        seen.setdefault(user_id, []).append(number)
+
+    # Users take turns, so arrivals interleave like real traffic
+    updates = []
+    for number in range(args.updates):
+        for user_id in range(1, args.users + 1):
+            user = User(user_id, f"user{user_id}", False)
+            message = Message(number, datetime.datetime.now(), Chat(user_id, ChatType.PRIVATE), from_user=user, text="hi")
+            updates.append((Update(len(updates) + 1, message=message), user_id, number))
+
+    started = time.monotonic()
+    # Like Application: one task per update, in arrival order
+    await asyncio.gather(*(
+        processor.process_update(update, handler(user_id, number)) for update, user_id, number in updates
+    ))
+    elapsed = time.monotonic() - started
+    ordered = all(numbers == sorted(numbers) for numbers in seen.values())
+    return len(updates) / elapsed, ordered
+
+
+def update(user_id, number):
+    user = User(user_id, f"user{user_id}", False)
+    message = Message(number, datetime.datetime.now(), Chat(user_id, ChatType.PRIVATE), from_user=user, text="hi")
+    return Update(user_id * 100000 + number, message=message)
+
+
+async def run_backlog(limit, args):
+    processor = PerUserUpdateProcessor(limit)
+    loop = asyncio.get_running_loop()
+    handlers = [asyncio.sleep(args.slow_time) for _ in range(limit + 1)]
+    backlog = [
+        loop.create_task(processor.process_update(update(1, number), handler))
+        for number, handler in enumerate(handlers)
+    ]
+    await asyncio.sleep(0)  # Let the backlog arrive first
+    started = time.monotonic()
+    await processor.process_update(update(2, 0), asyncio.sleep(args.handler_time))
+    elapsed = time.monotonic() - started
+    for task in backlog:
+        task.cancel()
+    with suppress(asyncio.CancelledError):
+        await asyncio.gather(*backlog)
+    for handler in handlers:
+        handler.close()
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=50)
+    parser.add_argument("--updates", type=int, default=20, help="updates per user")
+    parser.add_argument("--handler-time", type=float, default=0.01)
+    parser.add_argument("--slow-time", type=float, default=0.5, help="handler time of the backlogged updates")
+    parser.add_argument("--limits", default="1,4,16,64", help="MAX_CONCURRENT_UPDATES values to try")
+    args = parser.parse_args()
+
+    print(f"{'limit':>6}{'updates/s':>12}  in order{'behind a backlog':>20}")
+    for limit in (int(limit) for limit in args.limits.split(",")):
+        throughput, ordered = asyncio.run(run(limit, args))
+        waited = asyncio.run(run_backlog(limit, args))
+        print(f"{limit:>6}{throughput:>12.0f}  {'yes' if ordered else 'NO ':<8}{waited * 1000:>18.0f}ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+"""First-token latency of a cold model vs one kept warm by ModelManager.
+
+Starts a stub Ollama whose models take ``--load-time`` seconds to load and
+are unloaded ``--keep-alive`` seconds after their last request, then times
+the first streamed token of a chat request:
+
+- cold: nothing loaded the model;
+- preloaded: ModelManager.preload() ran at startup;
+- idle: the model was used, then left idle past its keep_alive;
+- idle + keep_warm: the same, with the keep_warm job running.
+
+Each case uses its own model name so they don't warm each other up.
+
+    python bench_warmup.py --load-time 5 --keep-alive 4
+"""
+import argparse
+import asyncio
+import time
+from contextlib import aclosing
+
+import stub_ollama
+from backend_pool import BackendPool
+from loadtest import start_stubs
+from model_manager import ModelManager
+
+
+async def first_token(pool, model, keep_alive):
+    started = time.monotonic()
+    stream = await pool.chat(model=model, messages=[{"role": "user", "content": "hi"}], stream=True,
+                             keep_alive=keep_alive)
+    async with aclosing(stream):
+        async for part in stream:
+            if part.message.content:
+                return time.monotonic() - started
+
+
+async def run(host, args):
+    pool = BackendPool([host], hedge=False)
+    keep_alive = f"{args.keep_alive}s"
+    results = {}
+    try:
+        results["cold"] = await first_token(pool, "cold", keep_alive)
+
+        await ModelManager(pool, ["preloaded"], default_keep_alive=keep_alive).preload()
+        results["preloaded"] = await first_token(pool, "preloaded", keep_alive)
+
+        await first_token(pool, "idle", keep_alive)
+        await asyncio.sleep(args.keep_alive + args.idle)
+        results["idle"] = await first_token(pool, "idle", keep_alive)
+
+        manager = ModelManager(pool, ["idle+keep_warm"], default_keep_alive=keep_alive)
+        await first_token(pool, "idle+keep_warm", keep_alive)
+
+        async def keep_warm():
+            while True:
+                await asyncio.sleep(args.keep_alive / 2)
+                await manager.keep_warm()
+
+        job = asyncio.ensure_future(keep_warm())
+        await asyncio.sleep(args.keep_alive + args.idle)
+        results["idle + keep_warm"] = await first_token(pool, "idle+keep_warm", keep_alive)
+        job.cancel()
+    finally:
+        await pool.close()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--keep-alive", type=float, default=4.0, help="seconds a model stays loaded")
+    parser.add_argument("--idle", type=float, default=2.0, help="extra idle time past keep_alive")
+    stub_ollama.add_arguments(parser)
+    parser.set_defaults(load_time=5.0, stubs=1)
+    args = parser.parse_args()
+
+    hosts, processes = start_stubs(args)
+    try:
+        results = asyncio.run(run(hosts[0], args))
+    finally:
+        for process in processes:
+            process.terminate()
+    print(f"{'':18}first token (load {args.load_time:.0f}s, keep_alive {args.keep_alive:.0f}s)")
+    for name, seconds in results.items():
+        print(f"{name:18}{seconds * 1000:8.0f}ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,77 @@
+from collections import OrderedDict
+
+CONVERSATION_SUMMARY_SCHEMA = """
+CREATE TABLE IF NOT EXISTS conversation_summary (
+    user_id TEXT PRIMARY KEY,
+    summary TEXT,
+    last_id INTEGER
+)
+"""
+
+MESSAGE_OVERHEAD = 4  # Role and separator tokens of a chat message
+
+
+def estimate_tokens(text):
+    # ~4 bytes per token for English BPE vocabularies; cheap and close
+    # enough to keep prompts within budget
+    return len(text.encode()) // 4 + MESSAGE_OVERHEAD
+
+
+def pack_turns(turns, budget):
+    """Return the newest of ``turns`` that fit in ``budget`` tokens.
+
+    ``turns`` are ``(id, user message, assistant message)`` tuples, oldest
+    first; a turn is kept or dropped as a whole.
+    """
+    kept = []
+    for turn in reversed(turns):
+        cost = estimate_tokens(turn[1]['content']) + estimate_tokens(turn[2]['content'])
+        if cost > budget:
+            break
+        budget -= cost
+        kept.append(turn)
+    kept.reverse()
+    return kept
+
+
+class SummaryStore:
+    """Rolling per-user summaries of turns that no longer fit the prompt.
+
+    A summary covers every turn of the user up to and including
+    ``last_id``. The summaries of the ``max_users`` most recently used
+    users are kept in memory; the rest are read back when needed.
+    """
+
+    def __init__(self, db, max_users=10000):
+        self.db = db
+        self.max_users = max_users
+        self._summaries = OrderedDict()  # user_id -> (summary, last_id)
+
+    async def get(self, user_id):
+        entry = self._summaries.get(user_id)
+        if entry is not None:
+            self._summaries.move_to_end(user_id)
+            return entry
+        row = await self.db.fetchone("""
+            SELECT summary, last_id FROM conversation_summary WHERE user_id = ?
+        """, (user_id,))
+        # A set() while reading wins over the row read
+        entry = self._summaries.get(user_id) or row or ("", 0)
+        self._remember(user_id, entry)
+        return entry
+
+    def _remember(self, user_id, entry):
+        self._summaries[user_id] = entry
+        self._summaries.move_to_end(user_id)
+        while len(self._summaries) > self.max_users:
+            self._summaries.popitem(last=False)
+
+    async def set(self, user_id, summary, last_id):
+        self._remember(user_id, (summary, last_id))
+        await self.db.execute("""
+            INSERT INTO conversation_summary (user_id, summary, last_id)
+            VALUES (?, ?, ?)
+            ON CONFLICT(user_id) DO UPDATE SET
+                summary = excluded.summary,
+                last_id = excluded.last_id
+        """, (user_id, summary, last_id))
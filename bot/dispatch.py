@@ -0,0 +1,133 @@
+import asyncio
+import logging
+import time
+from collections import OrderedDict, deque
+
+
+class QueueFull(Exception):
+    pass
+
+
+class FairQueue:
+    """Two-level weighted fair queue: chats, then users within a chat.
+
+    Every chat with queued work has a virtual time that advances by
+    ``1 / weight`` for each job it is served, and the chat with the lowest
+    virtual time goes next. A chat that becomes active starts at the lowest
+    virtual time in use, so idle chats can't bank credit. Inside a chat,
+    users are served round-robin.
+    """
+
+    def __init__(self, weights=None):
+        self.weights = weights or {}
+        self._chats = {}  # chat_id -> OrderedDict(user_id -> deque of jobs)
+        self._vtime = {}
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    def push(self, chat_id, user_id, job):
+        users = self._chats.get(chat_id)
+        if users is None:
+            users = self._chats[chat_id] = OrderedDict()
+            floor = min((self._vtime[c] for c in self._chats if c != chat_id), default=0.0)
+            self._vtime[chat_id] = max(self._vtime.get(chat_id, 0.0), floor)
+        users.setdefault(user_id, deque()).append(job)
+        self._size += 1
+
+    def pop(self):
+        chat_id = min(self._chats, key=self._vtime.__getitem__)
+        users = self._chats[chat_id]
+        user_id, jobs = next(iter(users.items()))
+        job = jobs.popleft()
+        if jobs:
+            users.move_to_end(user_id)
+        else:
+            del users[user_id]
+        if not users:
+            del self._chats[chat_id]
+        self._vtime[chat_id] += 1.0 / self.weights.get(chat_id, 1.0)
+        self._size -= 1
+        if not self._chats:
+            self._vtime.clear()
+        return job
+
+
+class LLMDispatcher:
+    """Bounded queue of LLM jobs served by a fixed number of workers.
+
+    :meth:`submit` takes a zero-argument coroutine function and returns an
+    :class:`asyncio.Future` for its result together with its position in
+    line (0 when a worker is free). At most ``workers`` jobs run at once
+    and at most ``max_queue`` wait; beyond that :class:`QueueFull` is
+    raised. ``on_start``, if given, is called with the seconds the job
+    spent queued when a worker picks it up.
+    Cancelling the returned future cancels the job, whether it is still
+    queued or already running.
+    """
+
+    def __init__(self, workers=2, max_queue=100, chat_weights=None):
+        self.workers = workers
+        self.max_queue = max_queue
+        self._queue = FairQueue(chat_weights)
+        self._items = asyncio.Semaphore(0)
+        self._tasks = []
+        self.running = 0
+
+    def submit(self, chat_id, user_id, job, on_start=None):
+        if len(self._queue) >= self.max_queue:
+            raise QueueFull()
+        future = asyncio.get_running_loop().create_future()
+        position = max(len(self._queue) + self.running - self.workers + 1, 0)
+        self._queue.push(chat_id, user_id, (future, job, on_start, time.monotonic()))
+        self._items.release()
+        return future, position
+
+    def queued(self):
+        return len(self._queue)
+
+    async def _worker(self):
+        while True:
+            await self._items.acquire()
+            future, job, on_start, queued = self._queue.pop()
+            if future.done():
+                continue
+            if on_start is not None:
+                on_start(time.monotonic() - queued)
+
+            self.running += 1
+            task = asyncio.get_running_loop().create_task(job())
+            future.add_done_callback(lambda f, task=task: task.cancel() if f.cancelled() else None)
+            try:
+                result = await asyncio.shield(task)
+            except asyncio.CancelledError:
+                if not task.done():
+                    # The worker itself is being stopped
+                    task.cancel()
+                    raise
+                if not future.done():
+                    future.cancel()
+            except Exception as e:
+                logging.error(f"Error in LLM job: {e}")
+                if not future.done():
+                    future.set_exception(e)
+            else:
+                if not future.done():
+                    future.set_result(result)
+            finally:
+                self.running -= 1
+
+    def start(self):
+        loop = asyncio.get_running_loop()
+        while len(self._tasks) < self.workers:
+            self._tasks.append(loop.create_task(self._worker()))
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks.clear()
+        while len(self._queue):
+            future = self._queue.pop()[0]
+            future.cancel()
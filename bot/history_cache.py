@@ -0,0 +1,121 @@
+from collections import OrderedDict, deque
+
+
+def _turn_size(user_message, bot_response):
+    return len(user_message.encode()) + len(bot_response.encode())
+
+
+def _last(ring, limit):
+    # (id, user message dict, assistant message dict) for the newest turns
+    return [turn[:3] for turn in list(ring)[max(len(ring) - limit, 0):]]
+
+
+class HistoryCache:
+    """LRU of the most recent conversation turns per user.
+
+    Each user maps to a ring buffer of at most ``turns`` entries holding the
+    turn id and the ready-made ``{'role': ..., 'content': ...}`` dicts. The
+    cache is bounded both by the number of users and by the total size of
+    the cached text; the least recently used users are evicted first.
+
+    A miss is filled with :meth:`begin_load` before the database read and
+    :meth:`load` after it. A turn appended in between may be missing from
+    the rows read, so that load is dropped and the next read retries.
+    """
+
+    def __init__(self, turns=5, max_users=10000, max_bytes=64 * 1024 * 1024):
+        self.turns = turns
+        self.max_users = max_users
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._users = OrderedDict()
+        self._loading = {}  # user_id -> [loads in flight, appends since]
+
+    def get(self, user_id, limit):
+        ring = self._users.get(user_id)
+        if ring is None or limit > self.turns:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._users.move_to_end(user_id)
+        return _last(ring, limit)
+
+    def begin_load(self, user_id):
+        # Version to hand to load() once the rows have been read
+        loading = self._loading.setdefault(user_id, [0, 0])
+        loading[0] += 1
+        return loading[1]
+
+    def abort_load(self, user_id):
+        self._end_load(user_id)
+
+    def _end_load(self, user_id, version=None):
+        # True unless a turn was appended since begin_load()
+        loading = self._loading[user_id]
+        loading[0] -= 1
+        if not loading[0]:
+            del self._loading[user_id]
+        return loading[1] == version
+
+    def load(self, user_id, rows, version):
+        # rows are (id, user_message, bot_response), oldest first
+        if not self._end_load(user_id, version):
+            return
+        self.discard(user_id)
+        ring = deque(maxlen=self.turns)
+        self._users[user_id] = ring
+        for turn_id, user_message, bot_response in rows[-self.turns:]:
+            self._push(ring, turn_id, user_message, bot_response)
+        self._shrink()
+
+    def append(self, user_id, turn_id, user_message, bot_response):
+        # Write-through: only users already cached are updated, a miss
+        # reloads the full window from the database
+        if user_id in self._loading:
+            self._loading[user_id][1] += 1
+        ring = self._users.get(user_id)
+        if ring is None:
+            return
+        if ring and ring[-1][0] >= turn_id:
+            # Already read by the load, or saves finished out of order
+            if all(turn[0] != turn_id for turn in ring):
+                self.discard(user_id)
+            return
+        self._users.move_to_end(user_id)
+        self._push(ring, turn_id, user_message, bot_response)
+        self._shrink()
+
+    def discard(self, user_id):
+        ring = self._users.pop(user_id, None)
+        if ring is not None:
+            self.size -= sum(turn[3] for turn in ring)
+
+    def stats(self):
+        return {
+            "users": len(self._users),
+            "bytes": self.size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+    def _push(self, ring, turn_id, user_message, bot_response):
+        if len(ring) == ring.maxlen:
+            self.size -= ring[0][3]
+        size = _turn_size(user_message, bot_response)
+        ring.append((
+            turn_id,
+            {'role': 'user', 'content': user_message},
+            {'role': 'assistant', 'content': bot_response},
+            size
+        ))
+        self.size += size
+
+    def _shrink(self):
+        while self._users and (len(self._users) > self.max_users or self.size > self.max_bytes):
+            user_id, _ = next(iter(self._users.items()))
+            self.discard(user_id)
+            self.evictions += 1
@@ -0,0 +1,61 @@
+from bisect import bisect_left, insort
+
+from xp import apply_gain
+
+
+class Leaderboard:
+    """In-memory mirror of ``user_ranks`` ordered by (level, xp).
+
+    ``_order`` is a sorted list of ``(-level, -xp, user_id)`` keys, so the
+    top of the board is its head and :meth:`top` only touches the entries
+    it returns, while :meth:`position` is a binary search over it. Scores
+    are updated incrementally as XP is gained, ahead of the batched
+    database flush.
+    """
+
+    def __init__(self):
+        self._scores = {}
+        self._order = []
+
+    def __len__(self):
+        return len(self._scores)
+
+    def load(self, rows):
+        # rows are (user_id, username, level, xp) from user_ranks
+        self._scores = {user_id: (username, level, xp) for user_id, username, level, xp in rows}
+        self._order = sorted((-level, -xp, user_id) for user_id, (_, level, xp) in self._scores.items())
+
+    def add(self, user_id, username, gain):
+        entry = self._scores.get(user_id)
+        if entry is None:
+            level, xp = apply_gain(1, 0, gain)
+            self._scores[user_id] = (username, level, xp)
+            insort(self._order, (-level, -xp, user_id))
+            return
+        if not gain:
+            return
+
+        username, old_level, old_xp = entry
+        level, xp = apply_gain(old_level, old_xp, gain)
+        del self._order[bisect_left(self._order, (-old_level, -old_xp, user_id))]
+        insort(self._order, (-level, -xp, user_id))
+        self._scores[user_id] = (username, level, xp)
+
+    def score(self, user_id):
+        return self._scores.get(user_id)
+
+    def position(self, user_id):
+        # 1 + the number of users with a strictly higher score, so tied
+        # users share a position
+        entry = self._scores.get(user_id)
+        if entry is None:
+            return None
+        _, level, xp = entry
+        return bisect_left(self._order, (-level, -xp)) + 1
+
+    def top(self, limit):
+        board = []
+        for _, _, user_id in self._order[:limit]:
+            username, level, xp = self._scores[user_id]
+            board.append((username, level, xp))
+        return board
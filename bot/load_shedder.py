@@ -0,0 +1,57 @@
+import time
+from collections import Counter, deque
+
+NORMAL = 0
+TRIM = 1  # Shorter replies and less history
+DOWNGRADE = 2  # Also the smaller model
+REJECT = 3  # Answer "busy" instead of queueing
+LEVELS = ("normal", "trim", "downgrade", "reject")
+
+
+class LoadShedder:
+    """Admission control for talk turns.
+
+    :meth:`level` grades the current pressure from ``NORMAL`` to
+    ``REJECT``. Each of ``depth_thresholds`` and ``latency_thresholds`` is
+    an ascending triple for the trim, downgrade and reject levels; the
+    queue depth is compared against the first, the p95 of the queue waits
+    recorded over the last ``window`` seconds against the second, and the
+    higher of the two levels wins. Old samples age out, so a period of
+    rejecting everything doesn't keep the level up by itself.
+    """
+
+    def __init__(self, depth_thresholds=(4, 8, 16), latency_thresholds=(20.0, 30.0, 45.0), window=60.0):
+        self.depth_thresholds = depth_thresholds
+        self.latency_thresholds = latency_thresholds
+        self.window = window
+        self.decisions = Counter()
+        self._samples = deque()  # (recorded, seconds waited)
+
+    def record(self, seconds):
+        now = time.monotonic()
+        self._samples.append((now, seconds))
+        self._expire(now)
+
+    def _expire(self, now):
+        while self._samples and self._samples[0][0] < now - self.window:
+            self._samples.popleft()
+
+    def latency(self):
+        self._expire(time.monotonic())
+        if not self._samples:
+            return 0.0
+        waits = sorted(seconds for _, seconds in self._samples)
+        return waits[min(int(len(waits) * 0.95), len(waits) - 1)]
+
+    def level(self, queue_depth):
+        latency = self.latency()
+        return max(
+            sum(queue_depth >= threshold for threshold in self.depth_thresholds),
+            sum(latency >= threshold for threshold in self.latency_thresholds)
+        )
+
+    def admit(self, queue_depth):
+        # level() for a new turn, counted in decisions
+        level = self.level(queue_depth)
+        self.decisions[LEVELS[level]] += 1
+        return level
@@ -0,0 +1,372 @@
+"""Synthetic talk traffic through the bot's handlers, against stub Ollama.
+
+Starts ``--stubs`` stub_ollama.py servers (or uses ``--ollama-hosts``),
+imports tbot with its databases in a scratch directory, and has
+``--users`` simulated users /talk to it through the real handlers and
+update processor; only the Telegram API is faked. Each user sends
+``--messages`` messages, waiting for the reply and then ``--think-time``
+seconds (exponentially distributed) before the next one. Users start
+within ``--ramp`` seconds, or arrive as a Poisson process of
+``--arrival-rate`` users per second, which keeps coming however slow the
+replies get. Meanwhile another user sends /rank every ``--rank-interval``
+seconds, to show how commands unrelated to the talk traffic fare.
+
+    python loadtest.py --users 200 --messages 5 --stubs 2 --tokens-per-sec 40 \\
+        --env LLM_WORKERS=8 --env FAST_MODEL=llama3.2:1b
+
+Reports throughput, reply and /rank latency percentiles and event-loop lag;
+``--json`` also writes them to a file.
+"""
+import argparse
+import asyncio
+import datetime
+import itertools
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+from collections import Counter, defaultdict
+
+from telegram import Chat, Message, Update, User
+from telegram.constants import ChatType
+
+import stub_ollama
+
+BOT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+PROMPTS = [
+    "hi!", "good morning Kisaragi", "thanks~", "how are you?", "I'm back", "lol",
+    "What should I cook for dinner tonight with rice, eggs and some leftover vegetables?",
+    "Why do cats purr, and is it always because they're happy?",
+    "Can you explain how compound interest works with a small example?",
+    "Write a short poem about a fox maid making tea on a rainy afternoon.",
+    "I had a long day at work and my boss kept changing the deadline. Any advice on staying calm?",
+    "/think What is the best way to learn a new language as an adult with a full-time job?",
+]
+
+
+def percentile(samples, fraction):
+    if not samples:
+        return float("nan")
+    ordered = sorted(samples)
+    return ordered[min(int(len(ordered) * fraction), len(ordered) - 1)]
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def start_stubs(args):
+    hosts, processes = [], []
+    stub_args = [
+        "--tokens-per-sec", str(args.tokens_per_sec),
+        "--first-token-delay", str(args.first_token_delay),
+        "--prefill-tokens-per-sec", str(args.prefill_tokens_per_sec),
+        "--reply-tokens", str(args.reply_tokens),
+        "--think-tokens", str(args.think_tokens),
+        "--error-rate", str(args.error_rate),
+        "--max-concurrency", str(args.max_concurrency),
+        "--max-queue", str(args.max_queue),
+        "--embed-dim", str(args.embed_dim),
+        "--load-time", str(args.load_time),
+        "--model-speeds", ",".join(f"{m}={s}" for m, s in args.model_speeds.items()),
+    ]
+    for index in range(args.stubs):
+        port = free_port()
+        seed = [] if args.seed is None else ["--seed", str(args.seed + index)]
+        processes.append(subprocess.Popen(
+            [sys.executable, os.path.join(BOT_DIR, "stub_ollama.py"), "--port", str(port), *stub_args, *seed],
+            stdout=subprocess.DEVNULL
+        ))
+        hosts.append(f"http://127.0.0.1:{port}")
+    for host in hosts:
+        for _ in range(100):
+            try:
+                urllib.request.urlopen(f"{host}/api/ps", timeout=1).read()
+                break
+            except OSError:
+                time.sleep(0.05)
+        else:
+            raise RuntimeError(f"Stub Ollama at {host} didn't start")
+    return hosts, processes
+
+
+def stub_stats(hosts):
+    stats = Counter()
+    for host in hosts:
+        try:
+            stats.update(json.loads(urllib.request.urlopen(f"{host}/stub/stats", timeout=2).read()))
+        except OSError:
+            pass
+    return stats
+
+
+class FakeBot:
+    """Just enough of telegram.Bot for the handlers, recording every message.
+
+    Events are attributed to users: in private chats by chat id, in groups
+    through the message a reply quotes and the placeholder being edited.
+    """
+
+    def __init__(self, api_latency):
+        self.api_latency = api_latency
+        self.events = defaultdict(list)  # user_id -> [(time, kind, text)]
+        self.owners = {}  # message_id -> user_id
+        self.private_chats = {}  # chat_id -> user_id
+        self._ids = itertools.count(1)
+
+    def message(self, chat, text, user=None):
+        message = Message(next(self._ids), datetime.datetime.now(), chat, from_user=user, text=text)
+        message.set_bot(self)
+        if user is not None:
+            self.owners[message.message_id] = user.id
+        return message
+
+    def _record(self, user_id, kind, text):
+        if user_id is not None:
+            self.events[user_id].append((time.monotonic(), kind, text))
+
+    async def send_message(self, chat_id, text, reply_parameters=None, **kwargs):
+        await asyncio.sleep(self.api_latency)
+        owner = self.owners.get(reply_parameters.message_id) if reply_parameters else self.private_chats.get(chat_id)
+        chat_type = ChatType.PRIVATE if chat_id in self.private_chats else ChatType.GROUP
+        sent = self.message(Chat(chat_id, chat_type), text)
+        self.owners[sent.message_id] = owner
+        self._record(owner, "send", text)
+        return sent
+
+    async def edit_message_text(self, text, chat_id=None, message_id=None, **kwargs):
+        await asyncio.sleep(self.api_latency)
+        self._record(self.owners.get(message_id), "edit", text)
+        return True
+
+    async def send_chat_action(self, chat_id, action, **kwargs):
+        await asyncio.sleep(self.api_latency)
+
+
+class FakeApplication:
+    """What the handlers and hooks use of telegram.ext.Application,
+    counting the errors its tasks raise instead of handling them."""
+
+    job_queue = None
+
+    def __init__(self):
+        self.errors = Counter()
+
+    def create_task(self, coroutine, update=None, **kwargs):
+        task = asyncio.get_running_loop().create_task(coroutine)
+        task.add_done_callback(self._done)
+        return task
+
+    def _done(self, task):
+        if not task.cancelled() and task.exception() is not None:
+            self.errors[type(task.exception()).__name__] += 1
+
+
+class LoadTest:
+    def __init__(self, tbot, args):
+        self.tbot = tbot
+        self.args = args
+        self.random = random.Random(args.seed)
+        self.bot = FakeBot(args.api_latency)
+        self.application = FakeApplication()
+        self.context = type("Context", (), {"bot": self.bot, "application": self.application})()
+        self.processor = tbot.PerUserUpdateProcessor(tbot.MAX_CONCURRENT_UPDATES)
+        self.update_ids = itertools.count(1)
+        self.turns = []  # (sent, first reply, first text, done, outcome)
+        self.rank_latency = []
+        self.lag = []
+
+    async def dispatch(self, chat, user, text):
+        # The same routing the Application's handlers do
+        update = Update(next(self.update_ids), message=self.bot.message(chat, text, user))
+        command = text.split()[0].split("@")[0] if text.startswith("/") else None
+        commands = {"/start": self.tbot.start, "/rank": self.tbot.rank, "/talk": self.tbot.talk, "/endtalk": self.tbot.endtalk}
+        handler = commands.get(command, self.tbot.handle_message)
+        await self.processor.process_update(update, handler(update, self.context))
+
+    async def settle(self, key):
+        # Until the bot has finished replying to this user
+        while self.tbot.generations.get(key):
+            await asyncio.wait(self.tbot.generations[key])
+
+    def outcome(self, text):
+        if text == self.tbot.BUSY_RESPONSE:
+            return "busy"
+        if self.tbot.ERROR_RESPONSE in text or text == self.tbot.TIMEOUT_RESPONSE:
+            return "error"
+        return "ok"
+
+    async def user(self, index, chat, start):
+        user = User(100000 + index, f"user{index}", False, username=f"user{index}")
+        if chat is None:
+            chat = Chat(user.id, ChatType.PRIVATE)
+            self.bot.private_chats[chat.id] = user.id
+        key = (str(chat.id), str(user.id))
+        await asyncio.sleep(start)
+        await self.dispatch(chat, user, "/talk")
+
+        for number in range(self.args.messages):
+            text = self.random.choice(PROMPTS)
+            if self.args.unique_prompts:
+                # Numbered so the caches and coalescing can't answer it
+                text = f"{text} ({user.id}.{number})"
+            events = self.bot.events[user.id]
+            seen = len(events)
+            sent = time.monotonic()
+            await self.dispatch(chat, user, text)
+            await asyncio.sleep(self.tbot.DEBOUNCE_WINDOW)
+            await self.settle(key)
+            done = time.monotonic()
+
+            replies = events[seen:]
+            notices = (self.tbot.STREAM_PLACEHOLDER, "in line")
+            content = [t for t, kind, text in replies if not any(n in text for n in notices)]
+            self.turns.append((
+                sent,
+                replies[0][0] if replies else done,
+                content[0] if content else done,
+                replies[-1][0] if replies else done,
+                self.outcome(replies[-1][2].strip("*")) if replies else "none",
+            ))
+            await asyncio.sleep(self.random.expovariate(1 / self.args.think_time))
+
+        await self.dispatch(chat, user, "/endtalk")
+
+    async def rank_user(self):
+        user = User(99999, "ranker", False, username="ranker")
+        chat = Chat(user.id, ChatType.PRIVATE)
+        self.bot.private_chats[chat.id] = user.id
+        await self.dispatch(chat, user, "/start")
+        while True:
+            await asyncio.sleep(self.args.rank_interval)
+            started = time.monotonic()
+            await self.dispatch(chat, user, "/rank")
+            self.rank_latency.append(time.monotonic() - started)
+
+    async def monitor_lag(self, interval=0.01):
+        while True:
+            started = time.monotonic()
+            await asyncio.sleep(interval)
+            self.lag.append(time.monotonic() - started - interval)
+
+    async def run(self):
+        await self.tbot.post_init(self.application)
+        loop = asyncio.get_running_loop()
+        monitors = [loop.create_task(self.monitor_lag())]
+        if self.args.rank_interval:
+            monitors.append(loop.create_task(self.rank_user()))
+        groups = [Chat(-1000 - i, ChatType.SUPERGROUP) for i in range(self.args.groups)]
+        if self.args.arrival_rate:
+            starts = list(itertools.accumulate(
+                self.random.expovariate(self.args.arrival_rate) for _ in range(self.args.users)
+            ))
+        else:
+            starts = [self.random.uniform(0, self.args.ramp) for _ in range(self.args.users)]
+        started = time.monotonic()
+        try:
+            await asyncio.gather(*(
+                self.user(i, groups[i % len(groups)] if groups else None, starts[i]) for i in range(self.args.users)
+            ))
+        finally:
+            elapsed = time.monotonic() - started
+            for monitor in monitors:
+                monitor.cancel()
+            await self.tbot.post_shutdown(self.application)
+        return elapsed
+
+    def report(self, elapsed, stub):
+        # Prints the report and returns it as a dict
+        outcomes = Counter(turn[4] for turn in self.turns)
+        ok = [turn for turn in self.turns if turn[4] == "ok"]
+        rows = {
+            "first reply": [turn[1] - turn[0] for turn in ok],
+            "first text": [turn[2] - turn[0] for turn in ok],
+            "full reply": [turn[3] - turn[0] for turn in ok],
+            "/rank": self.rank_latency,
+            "event-loop lag": self.lag,
+        }
+        print(f"\n{len(self.turns)} turns in {elapsed:.1f}s: {len(ok) / elapsed:.2f} replies/s, "
+              f"{dict(outcomes)}")
+        print(f"{'':16}{'p50':>9}{'p95':>9}{'p99':>9}{'max':>9}")
+        latencies = {}
+        for name, samples in rows.items():
+            cells = [percentile(samples, f) for f in (0.5, 0.95, 0.99)] + [max(samples, default=float("nan"))]
+            latencies[name] = dict(zip(("p50", "p95", "p99", "max"), cells))
+            print(f"{name:16}" + "".join(f"{cell * 1000:8.0f}ms" for cell in cells))
+        print(f"stub: {stub['tokens'] / elapsed:.0f} tokens/s, {stub['requests']} requests, "
+              f"{stub['errors']} errors, {stub['rejected']} rejected, {stub['disconnects']} disconnects")
+        print(f"bot: tiers {self.tbot.model_router.stats()}, admission {dict(self.tbot.load_shedder.decisions)}, "
+              f"backends {dict(self.tbot.client.metrics)}, errors {dict(self.application.errors)}")
+        return {
+            "turns": len(self.turns),
+            "seconds": elapsed,
+            "outcomes": dict(outcomes),
+            "latency": latencies,
+            "stub": dict(stub),
+            "tiers": self.tbot.model_router.stats(),
+            "admission": dict(self.tbot.load_shedder.decisions),
+            "errors": dict(self.application.errors),
+        }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=50)
+    parser.add_argument("--messages", type=int, default=5, help="messages per user")
+    parser.add_argument("--think-time", type=float, default=3.0, help="mean pause between a user's messages")
+    parser.add_argument("--ramp", type=float, default=5.0, help="users start within this many seconds")
+    parser.add_argument("--arrival-rate", type=float, default=0.0, help="users arriving per second instead of --ramp")
+    parser.add_argument("--unique-prompts", action="store_true", help="never repeat a message")
+    parser.add_argument("--groups", type=int, default=0, help="spread users over this many group chats (0 = private)")
+    parser.add_argument("--api-latency", type=float, default=0.05, help="simulated Telegram API round trip")
+    parser.add_argument("--rank-interval", type=float, default=0.5, help="seconds between /rank probes (0 = off)")
+    parser.add_argument("--stubs", type=int, default=1, help="stub Ollama servers to start")
+    parser.add_argument("--ollama-hosts", help="use these Ollama hosts instead of starting stubs")
+    parser.add_argument("--env", action="append", default=[], metavar="NAME=VALUE", help="bot setting")
+    parser.add_argument("--data-dir", help="keep the bot's databases here instead of a scratch directory")
+    parser.add_argument("--json", type=os.path.abspath, help="also write the results to this file")
+    stub_ollama.add_arguments(parser)
+    args = parser.parse_args()
+
+    processes = []
+    if args.ollama_hosts:
+        hosts = args.ollama_hosts.split(",")
+    else:
+        hosts, processes = start_stubs(args)
+    try:
+        os.environ.setdefault("TELEGRAM_BOT_TOKEN", "loadtest")
+        os.environ.setdefault("LOG_LEVEL", "WARNING")
+        os.environ["OLLAMA_HOSTS"] = ",".join(hosts)
+        for setting in args.env:
+            name, _, value = setting.partition("=")
+            os.environ[name] = value
+        # tbot keeps its databases in the working directory
+        os.chdir(args.data_dir or tempfile.mkdtemp(prefix="kisaragi-loadtest-"))
+        import tbot
+
+        test = LoadTest(tbot, args)
+        try:
+            elapsed = asyncio.run(test.run())
+        finally:
+            tbot.xp_engine.flush_sync()
+            tbot.conversation_db.close()
+            tbot.rank_db.close()
+        results = test.report(elapsed, stub_stats(hosts))
+        if args.json:
+            with open(args.json, "w") as f:
+                json.dump(results, f, indent=2)
+    finally:
+        for process in processes:
+            process.terminate()
+
+
+if __name__ == "__main__":
+    main()
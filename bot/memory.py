@@ -0,0 +1,139 @@
+import logging
+import os
+from collections import OrderedDict
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from storage import execute
+
+MEMORY_SCHEMA = """
+CREATE TABLE IF NOT EXISTS memory (
+    user_id TEXT,
+    slot INTEGER,
+    turn_id INTEGER,
+    PRIMARY KEY (user_id, slot)
+)
+"""
+
+
+class MemoryIndex:
+    """Per-user embedding index of past conversation turns.
+
+    Each user's turn embeddings are L2-normalised rows of a float32 matrix
+    memory-mapped from ``<directory>/<user_id>.npy``, so ranking all of a
+    user's turns against a query is one matrix-vector product over that
+    user's rows only, however many turns other users have. The matrix
+    doubles in capacity when it fills up. The ``memory`` table maps each
+    row (slot) back to its ``conversation`` id.
+
+    At most ``max_open`` users' matrices stay mapped at once. Needs numpy;
+    :attr:`available` is False without it.
+    """
+
+    available = np is not None
+
+    def __init__(self, client, db, directory, embed_model="all-minilm", max_open=256, initial_capacity=64):
+        self.client = client
+        self.db = db
+        self.directory = directory
+        self.embed_model = embed_model
+        self.max_open = max_open
+        self.initial_capacity = initial_capacity
+        self._open = OrderedDict()  # user_id -> [matrix or None, filled]
+
+    def _path(self, user_id):
+        return os.path.join(self.directory, f"{user_id}.npy")
+
+    async def _index(self, user_id):
+        entry = self._open.get(user_id)
+        if entry is not None:
+            self._open.move_to_end(user_id)
+            return entry
+
+        matrix = None
+        filled = 0
+        if os.path.exists(self._path(user_id)):
+            matrix = np.lib.format.open_memmap(self._path(user_id), mode="r+")
+            # Rows are unit vectors and unused rows are zero. The memory
+            # table can't tell: add() writes it in the background, so its
+            # last rows may still be queued
+            used = np.flatnonzero(matrix.any(axis=1))
+            filled = int(used[-1]) + 1 if used.size else 0
+        entry = self._open[user_id] = [matrix, filled]
+        while len(self._open) > self.max_open:
+            _, (old, _) = self._open.popitem(last=False)
+            if old is not None:
+                old.flush()
+        return entry
+
+    def _grow(self, user_id, entry, dim):
+        # Callers must not hold on to entry[0]: Windows can't replace a file
+        # that is still mapped, so every reference to the old map has to be
+        # gone before os.replace
+        filled = entry[1]
+        capacity = entry[0].shape[0] * 2 if entry[0] is not None else self.initial_capacity
+        path = self._path(user_id)
+        grown = np.lib.format.open_memmap(f"{path}.tmp", mode="w+", dtype=np.float32, shape=(capacity, dim))
+        if entry[0] is not None:
+            grown[:filled] = entry[0][:filled]
+        grown.flush()
+        del grown
+        entry[0] = None
+        os.replace(f"{path}.tmp", path)
+        entry[0] = np.lib.format.open_memmap(path, mode="r+")
+
+    async def embed(self, text):
+        response = await self.client.embed(model=self.embed_model, input=text)
+        vector = np.asarray(response.embeddings[0], dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    async def add(self, user_id, turn_id, text):
+        vector = await self.embed(text)
+        entry = await self._index(user_id)
+        filled = entry[1]
+        if entry[0] is not None and vector.shape[0] != entry[0].shape[1]:
+            logging.warning(f"Skipping memory for user {user_id}: embedding size changed")
+            return
+        if entry[0] is None or filled == entry[0].shape[0]:
+            os.makedirs(self.directory, exist_ok=True)
+            self._grow(user_id, entry, vector.shape[0])
+        entry[0][filled] = vector
+        entry[1] = filled + 1
+        self.db.submit(execute, """
+            INSERT OR REPLACE INTO memory (user_id, slot, turn_id) VALUES (?, ?, ?)
+        """, (user_id, filled, turn_id))
+
+    def _best(self, entry, vector, count, min_score):
+        # Slots of the count rows most similar to vector, best first. Kept
+        # out of search() so no reference to the map outlives the call
+        matrix, filled = entry
+        if matrix is None or not filled or vector.shape[0] != matrix.shape[1]:
+            return []
+        scores = matrix[:filled] @ vector
+        count = min(count, filled)
+        best = np.argpartition(-scores, count - 1)[:count]
+        best = best[np.argsort(-scores[best])]
+        return [int(slot) for slot in best if scores[slot] >= min_score]
+
+    async def search(self, user_id, vector, k=3, min_score=0.0, exclude=()):
+        # Ids of the user's k turns most similar to vector, best first
+        entry = await self._index(user_id)
+        # A few spare candidates make up for excluded turns
+        slots = self._best(entry, vector, k + len(exclude), min_score)
+        if not slots:
+            return []
+        rows = await self.db.fetchall(f"""
+            SELECT slot, turn_id FROM memory
+            WHERE user_id = ? AND slot IN ({",".join("?" * len(slots))})
+        """, (user_id, *slots))
+        turn_ids = dict(rows)
+        return [turn_ids[slot] for slot in slots if slot in turn_ids and turn_ids[slot] not in exclude][:k]
+
+    def flush(self):
+        for matrix, _ in self._open.values():
+            if matrix is not None:
+                matrix.flush()
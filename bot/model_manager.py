@@ -0,0 +1,79 @@
+import asyncio
+import logging
+import time
+
+from backend_pool import BackendUnavailable
+
+
+class ModelManager:
+    """Keeps the configured Ollama models loaded on every host.
+
+    A chat request with no messages makes Ollama load a model without
+    generating anything, and passing ``keep_alive`` with it (or with any
+    other request) resets how long the model stays in memory afterwards.
+    :meth:`keep_warm` is meant to run periodically: it checks residency via
+    ``ps()`` and reloads or refreshes each model accordingly.
+
+    Requests go through ``pool`` (a :class:`backend_pool.BackendPool`), so
+    they respect each host's slots and circuit breaker; hosts whose circuit
+    is open are skipped until it closes again.
+    """
+
+    def __init__(self, pool, models, keep_alive=None, default_keep_alive="30m"):
+        self.pool = pool
+        self.models = list(models)
+        self.keep_alive = keep_alive or {}
+        self.default_keep_alive = default_keep_alive
+        self.load_times = {}  # (host, model) -> seconds
+
+    def keep_alive_for(self, model):
+        return self.keep_alive.get(model, self.default_keep_alive)
+
+    async def load(self, host, model):
+        started = time.monotonic()
+        await self.pool.call_host(host, "chat", model=model, messages=[], keep_alive=self.keep_alive_for(model))
+        self.load_times[host, model] = time.monotonic() - started
+        return self.load_times[host, model]
+
+    async def resident(self, host):
+        response = await self.pool.call_host(host, "ps")
+        names = set()
+        for model in response.models:
+            names.update(filter(None, (model.model, model.name)))
+        return names
+
+    async def preload(self):
+        # Hosts load in parallel, models on one host one after another
+        await asyncio.gather(*(self._preload(backend.host) for backend in self.pool.backends))
+
+    async def _preload(self, host):
+        for model in self.models:
+            try:
+                elapsed = await self.load(host, model)
+                logging.info(f"Loaded model {model} on {host} in {elapsed:.1f}s")
+            except BackendUnavailable:
+                logging.warning(f"Not preloading models on {host}, it is unavailable")
+                return
+            except Exception as e:
+                logging.error(f"Error preloading model {model} on {host}: {e}")
+
+    async def keep_warm(self, context=None):
+        await asyncio.gather(*(self._keep_warm(backend.host) for backend in self.pool.backends))
+
+    async def _keep_warm(self, host):
+        try:
+            resident = await self.resident(host)
+        except BackendUnavailable:
+            return
+        except Exception as e:
+            logging.error(f"Error checking loaded models on {host}: {e}")
+            resident = set()
+        for model in self.models:
+            if model not in resident:
+                logging.warning(f"Model {model} is not loaded on {host}, reloading it")
+            try:
+                await self.load(host, model)
+            except BackendUnavailable:
+                return
+            except Exception as e:
+                logging.error(f"Error keeping model {model} loaded on {host}: {e}")
@@ -0,0 +1,89 @@
+import re
+from collections import deque
+
+THINK_COMMAND = re.compile(r"/think(@\w+)?(\s|$)")
+QUESTION_MARKERS = re.compile(r"\?|\b(why|how|explain|what if|compare|calculate|solve|code|write|translate)\b", re.IGNORECASE)
+
+
+class TierStats:
+    def __init__(self, window=200):
+        self.requests = 0
+        self.seconds = 0.0
+        self.recent = deque(maxlen=window)
+
+    def record(self, seconds):
+        self.requests += 1
+        self.seconds += seconds
+        self.recent.append(seconds)
+
+    def summary(self):
+        recent = sorted(self.recent)
+        return {
+            "requests": self.requests,
+            "mean": self.seconds / self.requests if self.requests else 0.0,
+            "p50": recent[len(recent) // 2] if recent else 0.0,
+            "p95": recent[int(len(recent) * 0.95)] if recent else 0.0,
+        }
+
+
+class ModelRouter:
+    """Picks a model tier for each prompt from cheap features.
+
+    ``tiers`` maps tier names to models and needs at least ``"deep"``;
+    without a ``"fast"`` tier everything goes to ``"deep"``. A prompt goes
+    to the fast tier only if none of these apply:
+
+    - it starts with ``/think`` (stripped by :meth:`split_prefix`),
+    - its chat has an override in ``chat_tiers``,
+    - the message is longer than ``fast_max_chars``,
+    - it looks like a question or task (see ``QUESTION_MARKERS``) and is
+      longer than ``question_max_chars``, so "how are you?" stays fast,
+    - the history in the prompt is over ``fast_max_history_tokens``.
+    """
+
+    def __init__(self, tiers, chat_tiers=None, fast_max_chars=80, question_max_chars=24,
+                 fast_max_history_tokens=1000):
+        self.tiers = tiers
+        self.chat_tiers = chat_tiers or {}
+        self.fast_max_chars = fast_max_chars
+        self.question_max_chars = question_max_chars
+        self.fast_max_history_tokens = fast_max_history_tokens
+        self.stats_by_tier = {tier: TierStats() for tier in tiers}
+
+    @staticmethod
+    def split_prefix(text):
+        # "/think ..." (or "/think@BotName ...") asks for the deep tier
+        match = THINK_COMMAND.match(text)
+        if match:
+            return "deep", text[match.end():].strip()
+        return None, text
+
+    def route(self, text, history_tokens=0, chat_id=None, tier=None):
+        if "fast" not in self.tiers:
+            return "deep"
+        if tier is not None:
+            return tier
+        tier = self.chat_tiers.get(chat_id)
+        if tier in self.tiers:
+            return tier
+        if len(text) > self.fast_max_chars:
+            return "deep"
+        if len(text) > self.question_max_chars and QUESTION_MARKERS.search(text):
+            return "deep"
+        if history_tokens > self.fast_max_history_tokens:
+            return "deep"
+        return "fast"
+
+    def model(self, tier):
+        return self.tiers[tier]
+
+    def tier_of(self, model):
+        # The first tier served by model, or None
+        return next((tier for tier, name in self.tiers.items() if name == model), None)
+
+    def record(self, tier, seconds):
+        self.stats_by_tier[tier].record(seconds)
+
+    def stats(self):
+        return {tier: stats.summary() for tier, stats in self.stats_by_tier.items()}
+
@@ -0,0 +1,103 @@
+import hashlib
+import json
+import time
+from collections import OrderedDict
+
+from storage import execute
+
+RESPONSE_CACHE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS response_cache (
+    key TEXT PRIMARY KEY,
+    response TEXT,
+    created REAL
+)
+"""
+
+
+def cache_key(model, messages):
+    # messages already carries the system prompt, the history turns and the
+    # new user message, in order
+    payload = json.dumps([model, messages], ensure_ascii=False, separators=(",", ":"))
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+class ResponseCache:
+    """Exact-match cache of model replies.
+
+    Entries are keyed by :func:`cache_key`, expire ``ttl`` seconds after
+    they were stored and are evicted least recently used first once
+    ``max_entries`` or ``max_bytes`` is exceeded. With a ``db`` every entry
+    is also written to the ``response_cache`` table and :meth:`load`
+    restores the unexpired ones after a restart.
+    """
+
+    def __init__(self, max_entries=1000, max_bytes=8 * 1024 * 1024, ttl=3600, db=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.db = db
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self._entries = OrderedDict()  # key -> (response, created)
+
+    def get(self, key):
+        entry = self._entries.get(key)
+        if entry is not None and time.time() - entry[1] > self.ttl:
+            self._remove(key)
+            self.expirations += 1
+            entry = None
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._entries.move_to_end(key)
+        return entry[0]
+
+    def put(self, key, response, created=None, persist=True):
+        created = created or time.time()
+        self._remove(key)
+        self._entries[key] = (response, created)
+        self.size += len(response.encode())
+        while self._entries and (len(self._entries) > self.max_entries or self.size > self.max_bytes):
+            self._remove(next(iter(self._entries)))
+            self.evictions += 1
+        if persist and self.db is not None:
+            self.db.submit(execute, """
+                INSERT OR REPLACE INTO response_cache (key, response, created)
+                VALUES (?, ?, ?)
+            """, (key, response, created))
+
+    def _remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.size -= len(entry[0].encode())
+
+    async def load(self):
+        rows = await self.db.fetchall("""
+            SELECT key, response, created FROM response_cache
+            WHERE created > ?
+            ORDER BY created DESC
+            LIMIT ?
+        """, (time.time() - self.ttl, self.max_entries))
+        for key, response, created in reversed(rows):
+            self.put(key, response, created, persist=False)
+
+    async def prune(self):
+        await self.db.execute("""
+            DELETE FROM response_cache WHERE created <= ?
+        """, (time.time() - self.ttl,))
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "bytes": self.size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+        }
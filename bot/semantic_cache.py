@@ -0,0 +1,127 @@
+import asyncio
+import logging
+import os
+import time
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from storage import execute
+
+SEMANTIC_CACHE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS semantic_cache (
+    slot INTEGER PRIMARY KEY,
+    model TEXT,
+    response TEXT,
+    created REAL
+)
+"""
+
+
+class SemanticCache:
+    """Nearest-neighbour cache of replies to short, history-free prompts.
+
+    Prompt embeddings are L2-normalised and stored as rows of a
+    ``capacity x dim`` float32 matrix memory-mapped from ``path`` (an
+    ``.npy`` file), so cosine similarity against every cached prompt is a
+    single matrix-vector product. At the default capacity that product
+    takes milliseconds, so :meth:`lookup` runs it in the default executor
+    (numpy releases the GIL) rather than on the event loop. Slots are reused oldest first once the
+    matrix is full. Replies live in the ``semantic_cache`` table next to
+    the slot they belong to.
+
+    Needs numpy; :attr:`available` is False without it.
+    """
+
+    available = np is not None
+
+    def __init__(self, client, db, path, embed_model="all-minilm", threshold=0.92, capacity=100000):
+        self.client = client
+        self.db = db
+        self.path = path
+        self.embed_model = embed_model
+        self.threshold = threshold
+        self.capacity = capacity
+        self.hits = 0
+        self.misses = 0
+        self._matrix = None
+        self._responses = {}  # slot -> (model, response)
+        self._next_slot = 0
+        self._filled = 0
+
+    async def load(self):
+        if not os.path.exists(self.path):
+            return
+        matrix = np.lib.format.open_memmap(self.path, mode="r+")
+        if matrix.dtype != np.float32 or matrix.shape[0] != self.capacity:
+            logging.warning(f"Ignoring semantic cache {self.path} with shape {matrix.shape}")
+            return
+        self._matrix = matrix
+        rows = await self.db.fetchall("""
+            SELECT slot, model, response FROM semantic_cache ORDER BY created
+        """)
+        for slot, model, response in rows:
+            self._responses[slot] = (model, response)
+            self._next_slot = (slot + 1) % self.capacity
+        self._filled = max(self._responses, default=-1) + 1
+
+    async def embed(self, text):
+        response = await self.client.embed(model=self.embed_model, input=text)
+        vector = np.asarray(response.embeddings[0], dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    @staticmethod
+    def _best(matrix, filled, vector):
+        # (slot, score) of the cached prompt most similar to vector
+        scores = matrix[:filled] @ vector
+        slot = int(np.argmax(scores))
+        return slot, float(scores[slot])
+
+    async def lookup(self, vector, model):
+        matrix, filled = self._matrix, self._filled
+        if matrix is None or not filled or vector.shape[0] != matrix.shape[1]:
+            self.misses += 1
+            return None
+        slot, score = await asyncio.get_running_loop().run_in_executor(None, self._best, matrix, filled, vector)
+        entry = self._responses.get(slot)
+        # add() may have reused the slot while the scores were computed
+        if (score < self.threshold or entry is None or entry[0] != model
+                or float(matrix[slot] @ vector) < self.threshold):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return entry[1]
+
+    def add(self, vector, model, response):
+        if self._matrix is None:
+            self._matrix = np.lib.format.open_memmap(
+                self.path, mode="w+", dtype=np.float32, shape=(self.capacity, vector.shape[0])
+            )
+        elif vector.shape[0] != self._matrix.shape[1]:
+            return
+
+        slot = self._next_slot
+        self._matrix[slot] = vector
+        self._responses[slot] = (model, response)
+        self._next_slot = (slot + 1) % self.capacity
+        self._filled = max(self._filled, slot + 1)
+        self.db.submit(execute, """
+            INSERT OR REPLACE INTO semantic_cache (slot, model, response, created)
+            VALUES (?, ?, ?, ?)
+        """, (slot, model, response, time.time()))
+
+    def flush(self):
+        if self._matrix is not None:
+            self._matrix.flush()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._responses),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
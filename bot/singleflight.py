@@ -0,0 +1,41 @@
+import asyncio
+
+
+class SingleFlight:
+    """Coalesces concurrent calls that share a key into one.
+
+    The first caller for a key starts ``fn()`` as a task, later callers
+    with the same key await that task instead of starting their own. The
+    task is cancelled only once every caller waiting on it has been
+    cancelled.
+    """
+
+    def __init__(self):
+        self.calls = 0
+        self.coalesced = 0
+        self._inflight = {}  # key -> [task, waiters]
+
+    def __contains__(self, key):
+        return key in self._inflight
+
+    def stats(self):
+        return {"inflight": len(self._inflight), "calls": self.calls, "coalesced": self.coalesced}
+
+    async def do(self, key, fn):
+        call = self._inflight.get(key)
+        if call is None:
+            task = asyncio.get_running_loop().create_task(fn())
+            call = self._inflight[key] = [task, 0]
+            task.add_done_callback(lambda _: self._inflight.pop(key, None))
+            self.calls += 1
+        else:
+            self.coalesced += 1
+
+        task = call[0]
+        call[1] += 1
+        try:
+            return await asyncio.shield(task)
+        finally:
+            call[1] -= 1
+            if not call[1] and not task.done():
+                task.cancel()
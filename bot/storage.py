@@ -0,0 +1,166 @@
+import asyncio
+import queue
+import sqlite3
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+
+_STOP = object()
+
+# journal_mode and synchronous only apply to the writer; readers share the
+# memory-map and page-cache settings
+DEFAULT_PRAGMAS = {
+    "journal_mode": "WAL",
+    "synchronous": "NORMAL",
+    "mmap_size": 256 * 1024 * 1024,
+    "cache_size": -16000,  # Negative values are KiB
+}
+WRITER_ONLY_PRAGMAS = ("journal_mode", "synchronous")
+
+
+class Database:
+    """SQLite database that never touches the event loop thread.
+
+    A single writer thread owns the read-write connection and applies
+    queued operations one at a time, so writes are serialised without
+    sharing a connection between threads. Queries run on a small pool of
+    read-only connections, which WAL mode lets proceed while a write is in
+    progress. Every public method except :meth:`submit` and :meth:`close`
+    is awaitable.
+    """
+
+    def __init__(self, path, schema=(), migrations=(), readers=4, pragmas=None):
+        self.path = path
+        self.pragmas = {**DEFAULT_PRAGMAS, **(pragmas or {})}
+        self._queue = queue.SimpleQueue()
+        self._writer = threading.Thread(target=self._run_writer, name=f"sqlite-writer:{path}", daemon=True)
+        self._writer.start()
+        self._local = threading.local()
+        self._reader_connections = []
+        self._reader_lock = threading.Lock()
+        self._readers = ThreadPoolExecutor(max_workers=readers, thread_name_prefix=f"sqlite-reader:{path}")
+
+        # Schema and migrations have to exist before the first reader opens
+        self.submit(self._setup, schema, migrations).result()
+
+    def _connect_writer(self):
+        conn = sqlite3.connect(self.path)
+        for name, value in self.pragmas.items():
+            conn.execute(f"PRAGMA {name}={value}")
+        return conn
+
+    def _connect_reader(self):
+        conn = sqlite3.connect(f"file:{self.path}?mode=ro", uri=True, check_same_thread=False)
+        conn.execute("PRAGMA query_only=ON")
+        for name, value in self.pragmas.items():
+            if name not in WRITER_ONLY_PRAGMAS:
+                conn.execute(f"PRAGMA {name}={value}")
+        return conn
+
+    @staticmethod
+    def _setup(conn, schema, migrations):
+        for statement in schema:
+            conn.execute(statement)
+        conn.commit()
+        migrate(conn, migrations)
+        conn.execute("PRAGMA optimize")
+
+    def _run_writer(self):
+        conn = self._connect_writer()
+        try:
+            while True:
+                item = self._queue.get()
+                if item is _STOP:
+                    break
+                future, op, args = item
+                if not future.set_running_or_notify_cancel():
+                    continue
+                try:
+                    result = op(conn, *args)
+                except BaseException as e:
+                    if conn.in_transaction:
+                        conn.rollback()
+                    future.set_exception(e)
+                else:
+                    future.set_result(result)
+        finally:
+            conn.close()
+
+    def submit(self, op, *args):
+        """Queue ``op(conn, *args)`` on the writer thread and return a
+        :class:`concurrent.futures.Future` for its result."""
+        future = Future()
+        self._queue.put((future, op, args))
+        return future
+
+    async def write(self, op, *args):
+        return await asyncio.wrap_future(self.submit(op, *args))
+
+    async def execute(self, sql, params=()):
+        return await self.write(execute, sql, params)
+
+    async def executemany(self, sql, seq_of_params):
+        return await self.write(executemany, sql, seq_of_params)
+
+    async def checkpoint(self, mode="PASSIVE"):
+        return await self.write(_checkpoint, mode)
+
+    async def optimize(self):
+        return await self.write(_optimize)
+
+    def _reader(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._local.conn = self._connect_reader()
+            with self._reader_lock:
+                self._reader_connections.append(conn)
+        return conn
+
+    def _fetchall(self, sql, params):
+        return self._reader().execute(sql, params).fetchall()
+
+    def _fetchone(self, sql, params):
+        return self._reader().execute(sql, params).fetchone()
+
+    async def fetchall(self, sql, params=()):
+        return await asyncio.get_running_loop().run_in_executor(self._readers, self._fetchall, sql, params)
+
+    async def fetchone(self, sql, params=()):
+        return await asyncio.get_running_loop().run_in_executor(self._readers, self._fetchone, sql, params)
+
+    def close(self):
+        # Drains every write queued so far before the connection is closed
+        self._queue.put(_STOP)
+        self._writer.join()
+        self._readers.shutdown(wait=True)
+        with self._reader_lock:
+            for conn in self._reader_connections:
+                conn.close()
+            self._reader_connections.clear()
+
+
+def execute(conn, sql, params):
+    with conn:
+        return conn.execute(sql, params).lastrowid
+
+
+def executemany(conn, sql, seq_of_params):
+    with conn:
+        return conn.executemany(sql, seq_of_params).rowcount
+
+
+def _checkpoint(conn, mode):
+    # (busy, wal pages, checkpointed pages)
+    return conn.execute(f"PRAGMA wal_checkpoint({mode})").fetchone()
+
+
+def _optimize(conn):
+    conn.execute("PRAGMA optimize")
+
+
+def migrate(db, migrations):
+    # PRAGMA user_version records how many migrations have been applied
+    version = db.execute("PRAGMA user_version").fetchone()[0]
+    for number, statement in enumerate(migrations[version:], start=version + 1):
+        with db:
+            db.execute(statement)
+            db.execute(f"PRAGMA user_version = {number}")
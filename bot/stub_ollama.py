@@ -0,0 +1,319 @@
+"""Stand-in for an Ollama server, for load tests without a GPU.
+
+Serves ``/api/chat`` (streaming and not), ``/api/embed`` and ``/api/ps``
+with made-up output at a configurable speed:
+
+    python stub_ollama.py --port 11500 --tokens-per-sec 40 --first-token-delay 0.3 \\
+        --max-concurrency 4 --error-rate 0.01 --load-time 8
+
+A model that isn't loaded (or whose keep_alive ran out) takes
+``--load-time`` seconds to load before it answers, like a cold start.
+
+``GET /stub/stats`` returns request and token counters.
+"""
+import argparse
+import asyncio
+import hashlib
+import json
+import random
+import time
+from datetime import datetime, timedelta, timezone
+
+WORDS = (
+    "yes master of course the fox maid kisaragi happily helps with every task tea "
+    "is ready and the house is clean today we could read a book or take a walk"
+).split()
+
+
+class HTTPError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+class StubOllama:
+    def __init__(self, tokens_per_sec=30.0, first_token_delay=0.2, prefill_tokens_per_sec=0.0,
+                 reply_tokens=120, think_tokens=0, error_rate=0.0, max_concurrency=4, max_queue=512,
+                 embed_dim=384, model_speeds=None, load_time=0.0, seed=None):
+        self.tokens_per_sec = tokens_per_sec
+        self.first_token_delay = first_token_delay
+        self.prefill_tokens_per_sec = prefill_tokens_per_sec
+        self.reply_tokens = reply_tokens
+        self.think_tokens = think_tokens
+        self.error_rate = error_rate
+        self.max_queue = max_queue
+        self.embed_dim = embed_dim
+        self.model_speeds = model_speeds or {}
+        self.load_time = load_time
+        self._loading = {}  # model -> task
+        self.random = random.Random(seed)
+        self.slots = asyncio.Semaphore(max_concurrency)
+        self.loaded = {}  # model -> expires_at
+        self.stats = {"requests": 0, "errors": 0, "rejected": 0, "disconnects": 0, "tokens": 0,
+                      "loads": 0, "waiting": 0, "running": 0}
+
+    async def _ensure_loaded(self, model, keep_alive=None):
+        # Concurrent requests for a cold model share one load
+        expires = self.loaded.get(model)
+        if expires is None or expires <= datetime.now(timezone.utc):
+            loading = self._loading.get(model)
+            if loading is None:
+                loading = self._loading[model] = asyncio.ensure_future(asyncio.sleep(self.load_time))
+                loading.add_done_callback(lambda _: self._loading.pop(model, None))
+                self.stats["loads"] += 1
+            await asyncio.shield(loading)
+        self._load(model, keep_alive)
+
+    def _load(self, model, keep_alive=None):
+        seconds = 300 if keep_alive is None else keep_alive
+        if isinstance(seconds, str):
+            units = {"s": 1, "m": 60, "h": 3600}
+            seconds = float(seconds[:-1]) * units[seconds[-1]] if seconds[-1] in units else float(seconds)
+        seconds = 10 ** 9 if seconds < 0 else seconds
+        self.loaded[model] = datetime.now(timezone.utc) + timedelta(seconds=seconds)
+
+    def _maybe_fail(self):
+        if self.random.random() < self.error_rate:
+            self.stats["errors"] += 1
+            raise HTTPError(500, "stub error")
+
+    def _tokens(self, body):
+        limit = (body.get("options") or {}).get("num_predict")
+        count = self.reply_tokens if limit is None or limit < 0 else min(limit, self.reply_tokens)
+        words = [self.random.choice(WORDS) for _ in range(count)]
+        tokens = [f" {word}" for word in words]
+        if self.think_tokens:
+            thoughts = [f" {self.random.choice(WORDS)}" for _ in range(self.think_tokens)]
+            tokens = ["<think>", *thoughts, "</think>", "\n\n", *tokens]
+        return tokens
+
+    def _prompt_tokens(self, messages):
+        return sum(len(message.get("content", "").encode()) // 4 for message in messages)
+
+    async def _slot(self):
+        # Like OLLAMA_NUM_PARALLEL / OLLAMA_MAX_QUEUE: wait for a slot, or
+        # 503 once too many are waiting
+        if self.stats["waiting"] >= self.max_queue:
+            self.stats["rejected"] += 1
+            raise HTTPError(503, "server busy, please try again.  maximum pending requests exceeded")
+        self.stats["waiting"] += 1
+        try:
+            await self.slots.acquire()
+        finally:
+            self.stats["waiting"] -= 1
+        self.stats["running"] += 1
+
+    def _release(self):
+        self.stats["running"] -= 1
+        self.slots.release()
+
+    async def chat(self, body, send):
+        model = body.get("model", "stub")
+        messages = body.get("messages") or []
+        started = time.monotonic()
+        await self._ensure_loaded(model, body.get("keep_alive"))
+        if not messages:
+            # An empty chat only loads the model
+            return await send(self._chat_part(model, "", done=True, done_reason="load"))
+
+        await self._slot()
+        try:
+            self._maybe_fail()
+            delay = self.first_token_delay
+            if self.prefill_tokens_per_sec:
+                delay += self._prompt_tokens(messages) / self.prefill_tokens_per_sec
+            await asyncio.sleep(delay)
+
+            tokens = self._tokens(body)
+            interval = 1.0 / self.model_speeds.get(model, self.tokens_per_sec)
+            if body.get("stream", True):
+                for token in tokens:
+                    await send(self._chat_part(model, token), more=True)
+                    self.stats["tokens"] += 1
+                    await asyncio.sleep(interval)
+                final = ""
+            else:
+                await asyncio.sleep(interval * len(tokens))
+                self.stats["tokens"] += len(tokens)
+                final = "".join(tokens).strip()
+            await send(self._chat_part(
+                model, final, done=True, done_reason="stop", eval_count=len(tokens),
+                total_duration=int((time.monotonic() - started) * 1e9)
+            ))
+        finally:
+            self._release()
+
+    def _chat_part(self, model, content, done=False, **extra):
+        return {
+            "model": model,
+            "created_at": datetime.now(timezone.utc).isoformat(),
+            "message": {"role": "assistant", "content": content},
+            "done": done,
+            **extra,
+        }
+
+    def _vector(self, text):
+        # Deterministic per text, so equal inputs get equal embeddings
+        seed = int.from_bytes(hashlib.sha256(text.encode()).digest()[:8], "big")
+        rng = random.Random(seed)
+        return [rng.gauss(0.0, 1.0) for _ in range(self.embed_dim)]
+
+    async def embed(self, body, send):
+        model = body.get("model", "stub")
+        inputs = body.get("input", "")
+        inputs = [inputs] if isinstance(inputs, str) else inputs
+        await self._ensure_loaded(model, body.get("keep_alive"))
+        await self._slot()
+        try:
+            self._maybe_fail()
+            await asyncio.sleep(0.002 * len(inputs))
+            await send({"model": model, "embeddings": [self._vector(text) for text in inputs]})
+        finally:
+            self._release()
+
+    async def ps(self, body, send):
+        now = datetime.now(timezone.utc)
+        self.loaded = {model: expires for model, expires in self.loaded.items() if expires > now}
+        await send({"models": [
+            {"name": model, "model": model, "expires_at": expires.isoformat(), "size": 0, "size_vram": 0}
+            for model, expires in self.loaded.items()
+        ]})
+
+    async def handle(self, reader, writer):
+        routes = {
+            ("POST", "/api/chat"): self.chat,
+            ("POST", "/api/embed"): self.embed,
+            ("GET", "/api/ps"): self.ps,
+        }
+        try:
+            while True:
+                try:
+                    head = await reader.readuntil(b"\r\n\r\n")
+                except (asyncio.IncompleteReadError, ConnectionError):
+                    return
+                request_line, *header_lines = head.decode("latin-1").split("\r\n")
+                method, path, _ = request_line.split(" ", 2)
+                headers = {}
+                for line in filter(None, header_lines):
+                    name, _, value = line.partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get("content-length", 0)))
+                keep_alive = headers.get("connection", "").lower() != "close"
+
+                if (method, path) == ("GET", "/stub/stats"):
+                    await self._respond(writer, 200, self.stats)
+                elif (method, path) == ("GET", "/"):
+                    await self._respond(writer, 200, "Ollama is running")
+                elif (method, path) in routes:
+                    self.stats["requests"] += 1
+                    if not await self._route(routes[method, path], body, writer):
+                        return
+                else:
+                    await self._respond(writer, 404, {"error": "not found"})
+                if not keep_alive:
+                    return
+        except ConnectionError:
+            self.stats["disconnects"] += 1
+        finally:
+            writer.close()
+
+    async def _route(self, handler, raw, writer):
+        # Returns False once the response can't be continued
+        started = False
+
+        async def send(payload, more=False):
+            nonlocal started
+            if not started:
+                started = True
+                writer.write(
+                    b"HTTP/1.1 200 OK\r\nContent-Type: application/x-ndjson\r\n"
+                    b"Transfer-Encoding: chunked\r\n\r\n"
+                )
+            line = json.dumps(payload).encode() + b"\n"
+            writer.write(b"%x\r\n%s\r\n" % (len(line), line))
+            if not more:
+                writer.write(b"0\r\n\r\n")
+            await writer.drain()
+
+        try:
+            await handler(json.loads(raw or b"{}"), send)
+        except HTTPError as e:
+            if started:
+                return False
+            await self._respond(writer, e.status, {"error": str(e)})
+        return True
+
+    async def _respond(self, writer, status, payload):
+        reason = {200: "OK", 404: "Not Found", 500: "Internal Server Error", 503: "Service Unavailable"}[status]
+        content_type = "application/json"
+        if isinstance(payload, str):
+            data, content_type = payload.encode(), "text/plain"
+        else:
+            data = json.dumps(payload).encode()
+        writer.write(
+            f"HTTP/1.1 {status} {reason}\r\nContent-Type: {content_type}\r\n"
+            f"Content-Length: {len(data)}\r\n\r\n".encode() + data
+        )
+        await writer.drain()
+
+
+def parse_model_speeds(value):
+    # "model=tokens_per_sec,model=tokens_per_sec"
+    speeds = {}
+    for item in filter(None, value.split(",")):
+        model, speed = item.rsplit("=", 1)
+        speeds[model.strip()] = float(speed)
+    return speeds
+
+
+def add_arguments(parser):
+    parser.add_argument("--tokens-per-sec", type=float, default=30.0)
+    parser.add_argument("--model-speeds", type=parse_model_speeds, default={},
+                        help='per-model tokens/sec, e.g. "llama3.2:1b=150"')
+    parser.add_argument("--first-token-delay", type=float, default=0.2)
+    parser.add_argument("--prefill-tokens-per-sec", type=float, default=0.0,
+                        help="adds prompt tokens / this to the first-token delay (0 = off)")
+    parser.add_argument("--reply-tokens", type=int, default=120)
+    parser.add_argument("--think-tokens", type=int, default=0, help="<think> block length, like deepseek-r1")
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--max-concurrency", type=int, default=4)
+    parser.add_argument("--max-queue", type=int, default=512)
+    parser.add_argument("--embed-dim", type=int, default=384)
+    parser.add_argument("--load-time", type=float, default=0.0, help="seconds to load a model that isn't loaded")
+    parser.add_argument("--seed", type=int)
+
+
+def stub_from_args(args):
+    return StubOllama(
+        tokens_per_sec=args.tokens_per_sec,
+        first_token_delay=args.first_token_delay,
+        prefill_tokens_per_sec=args.prefill_tokens_per_sec,
+        reply_tokens=args.reply_tokens,
+        think_tokens=args.think_tokens,
+        error_rate=args.error_rate,
+        max_concurrency=args.max_concurrency,
+        max_queue=args.max_queue,
+        embed_dim=args.embed_dim,
+        model_speeds=args.model_speeds,
+        load_time=args.load_time,
+        seed=args.seed,
+    )
+
+
+async def serve(stub, host, port):
+    server = await asyncio.start_server(stub.handle, host, port)
+    print(f"Stub Ollama listening on http://{host}:{port}", flush=True)
+    async with server:
+        await server.serve_forever()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=11434)
+    add_arguments(parser)
+    args = parser.parse_args()
+    try:
+        asyncio.run(serve(stub_from_args(args), args.host, args.port))
+    except KeyboardInterrupt:
+        pass
@@ -1,19 +1,39 @@
 import logging
 import sys
-import sqlite3
 import os
 import asyncio
-from concurrent.futures import ThreadPoolExecutor
+import time
+from collections import defaultdict
+from contextlib import aclosing
 from dotenv import load_dotenv
 
 from telegram import Update
-from telegram.constants import ChatAction
+from telegram.constants import ChatAction, ChatType, MessageLimit
+from telegram.error import BadRequest, RetryAfter
 from telegram.ext import (
     ApplicationBuilder, CommandHandler, MessageHandler,
     filters, ContextTypes
 )
 
-from ollama import chat, ChatResponse, Client
+import httpx
+from ollama import ChatResponse
+
+from update_processor import PerUserUpdateProcessor
+from xp import XPAccumulator, XP_PER_MESSAGE
+from leaderboard import Leaderboard
+from dispatch import LLMDispatcher, QueueFull
+from response_cache import ResponseCache, RESPONSE_CACHE_SCHEMA, cache_key
+from semantic_cache import SemanticCache, SEMANTIC_CACHE_SCHEMA
+from singleflight import SingleFlight
+from model_manager import ModelManager
+from backend_pool import BackendPool
+from model_router import ModelRouter
+from load_shedder import LoadShedder, TRIM, DOWNGRADE, REJECT
+from memory import MemoryIndex, MEMORY_SCHEMA
+from context import SummaryStore, CONVERSATION_SUMMARY_SCHEMA, estimate_tokens, pack_turns
+from think_filter import ThinkFilter, strip_reasoning, compress_reasoning
+from history_cache import HistoryCache
+from storage import Database
 
 load_dotenv("tekkit.env")
 TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
@@ -23,16 +43,24 @@ if not TOKEN:
 
 logging.basicConfig(
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    level=logging.WARNING
+    level=os.getenv("LOG_LEVEL", "INFO").upper()
 )
 logging.getLogger("telegram.ext").setLevel(logging.ERROR)
+# httpx and APScheduler log every request and job run at INFO
+logging.getLogger("httpx").setLevel(logging.WARNING)
+logging.getLogger("apscheduler").setLevel(logging.WARNING)
 print("Bot is running...")
 
-DB_PATH = "conversations.sqlite3"
-conn = sqlite3.connect(DB_PATH, check_same_thread=False)
-cursor = conn.cursor()
+SQLITE_PRAGMAS = {
+    "journal_mode": os.getenv("SQLITE_JOURNAL_MODE", "WAL"),
+    "synchronous": os.getenv("SQLITE_SYNCHRONOUS", "NORMAL"),
+    "mmap_size": int(os.getenv("SQLITE_MMAP_SIZE", str(256 * 1024 * 1024))),
+    "cache_size": int(os.getenv("SQLITE_CACHE_SIZE", "-16000")),
+}
+SQLITE_MAINTENANCE_INTERVAL = float(os.getenv("SQLITE_MAINTENANCE_INTERVAL", "300"))
 
-cursor.execute("""
+DB_PATH = "conversations.sqlite3"
+CONVERSATION_SCHEMA = ["""
 CREATE TABLE IF NOT EXISTS conversation (
     id INTEGER PRIMARY KEY AUTOINCREMENT,
     user_id TEXT,
@@ -40,124 +68,635 @@ CREATE TABLE IF NOT EXISTS conversation (
     bot_response TEXT,
     timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
 )
-""")
-conn.commit()
+"""]
+CONVERSATION_MIGRATIONS = [
+    "CREATE INDEX IF NOT EXISTS idx_conversation_user_id ON conversation (user_id, id DESC)",
+    RESPONSE_CACHE_SCHEMA,
+    SEMANTIC_CACHE_SCHEMA,
+    CONVERSATION_SUMMARY_SCHEMA,
+    "ALTER TABLE conversation ADD COLUMN reasoning BLOB",
+    MEMORY_SCHEMA,
+]
+conversation_db = Database(DB_PATH, schema=CONVERSATION_SCHEMA, migrations=CONVERSATION_MIGRATIONS, pragmas=SQLITE_PRAGMAS)
 
 RANK_DB_PATH = "ranks.sqlite3"
-rank_conn = sqlite3.connect(RANK_DB_PATH, check_same_thread=False)
-rank_cursor = rank_conn.cursor()
-
-rank_cursor.execute("""
+RANK_SCHEMA = ["""
 CREATE TABLE IF NOT EXISTS user_ranks (
     user_id TEXT PRIMARY KEY,
     username TEXT,
     xp INTEGER DEFAULT 0,
     level INTEGER DEFAULT 1
 )
-""")
-rank_conn.commit()
+"""]
+RANK_MIGRATIONS = [
+    "CREATE INDEX IF NOT EXISTS idx_user_ranks_level_xp ON user_ranks (level DESC, xp DESC, username)",
+    """
+    CREATE TABLE IF NOT EXISTS chat_ranks (
+        chat_id TEXT,
+        user_id TEXT,
+        username TEXT,
+        xp INTEGER DEFAULT 0,
+        level INTEGER DEFAULT 1,
+        PRIMARY KEY (chat_id, user_id)
+    )
+    """,
+]
+rank_db = Database(RANK_DB_PATH, schema=RANK_SCHEMA, migrations=RANK_MIGRATIONS, pragmas=SQLITE_PRAGMAS)
+
+LEADERBOARD_SIZE = 10
+leaderboard_cache = Leaderboard()
+chat_leaderboards = defaultdict(Leaderboard)
+
+XP_FLUSH_INTERVAL = float(os.getenv("XP_FLUSH_INTERVAL", "5.0"))
+XP_FLUSH_SIZE = int(os.getenv("XP_FLUSH_SIZE", "500"))
+xp_engine = XPAccumulator(rank_db, flush_interval=XP_FLUSH_INTERVAL, flush_size=XP_FLUSH_SIZE)
+
+MAX_MESSAGE_LENGTH = MessageLimit.MAX_TEXT_LENGTH
+
+# Most recent turns considered for the prompt; CONTEXT_TOKEN_BUDGET decides
+# how many of them are actually sent
+HISTORY_TURNS = int(os.getenv("HISTORY_TURNS", "20"))
+HISTORY_CACHE_USERS = int(os.getenv("HISTORY_CACHE_USERS", "10000"))
+HISTORY_CACHE_BYTES = int(os.getenv("HISTORY_CACHE_BYTES", str(64 * 1024 * 1024)))
+history_cache = HistoryCache(turns=HISTORY_TURNS, max_users=HISTORY_CACHE_USERS, max_bytes=HISTORY_CACHE_BYTES)
 
 active_talk_sessions = {}
-executor = ThreadPoolExecutor()
-client = Client(host='http://localhost:11434', timeout=60)
-
-def save_conversation(user_id, user_message, bot_response):
-    cursor.execute("""
-        INSERT INTO conversation (user_id, user_message, bot_response)
-        VALUES (?, ?, ?)
-    """, (user_id, user_message, bot_response))
-    conn.commit()
-
-async def save_conversation_async(user_id, user_message, bot_response):
-    await asyncio.get_event_loop().run_in_executor(
-        None,
-        save_conversation,
-        user_id, user_message, bot_response
+MAX_CONCURRENT_UPDATES = int(os.getenv("MAX_CONCURRENT_UPDATES", "32"))
+OLLAMA_HOST = os.getenv("OLLAMA_HOST", "http://localhost:11434")
+OLLAMA_HOSTS = [h.strip() for h in os.getenv("OLLAMA_HOSTS", OLLAMA_HOST).split(",") if h.strip()]
+OLLAMA_MAX_CONNECTIONS = int(os.getenv("OLLAMA_MAX_CONNECTIONS", "16"))
+
+def parse_host_limits(value):
+    # "host=max_inflight,host=max_inflight"
+    limits = {}
+    for item in filter(None, value.split(",")):
+        host, limit = item.rsplit("=", 1)
+        limits[host.strip()] = int(limit)
+    return limits
+
+# Requests beyond a host's limit wait for a slot; match it to the host's
+# OLLAMA_NUM_PARALLEL
+OLLAMA_HOST_MAX_INFLIGHT = int(os.getenv("OLLAMA_HOST_MAX_INFLIGHT", "4"))
+OLLAMA_HOST_LIMITS = parse_host_limits(os.getenv("OLLAMA_HOST_LIMITS", ""))
+OLLAMA_ROUTING = os.getenv("OLLAMA_ROUTING", "least")  # "least" or "ewma"
+OLLAMA_EJECT_AFTER = int(os.getenv("OLLAMA_EJECT_AFTER", "3"))
+OLLAMA_EJECT_TIME = float(os.getenv("OLLAMA_EJECT_TIME", "30"))
+OLLAMA_PROBE_INTERVAL = float(os.getenv("OLLAMA_PROBE_INTERVAL", "10"))
+# A host's circuit also opens once this share of its recent requests failed
+OLLAMA_BREAKER_ERROR_RATE = float(os.getenv("OLLAMA_BREAKER_ERROR_RATE", "0.5"))
+OLLAMA_BREAKER_WINDOW = int(os.getenv("OLLAMA_BREAKER_WINDOW", "20"))
+# Re-send a chat that is slower than the recent p95 to another host, or to
+# FAST_MODEL when there is no other host
+OLLAMA_HEDGE = os.getenv("OLLAMA_HEDGE", "1") == "1"
+OLLAMA_HEDGE_MIN_DELAY = float(os.getenv("OLLAMA_HEDGE_MIN_DELAY", "1.0"))
+# Each host gets its own pooled httpx connection set, shared by every
+# in-flight generation on it
+client = BackendPool(
+    OLLAMA_HOSTS,
+    max_inflight=OLLAMA_HOST_MAX_INFLIGHT,
+    host_limits=OLLAMA_HOST_LIMITS,
+    routing=OLLAMA_ROUTING,
+    eject_after=OLLAMA_EJECT_AFTER,
+    eject_time=OLLAMA_EJECT_TIME,
+    error_rate=OLLAMA_BREAKER_ERROR_RATE,
+    error_window=OLLAMA_BREAKER_WINDOW,
+    hedge=OLLAMA_HEDGE,
+    hedge_min_delay=OLLAMA_HEDGE_MIN_DELAY,
+    timeout=60,
+    limits=httpx.Limits(
+        max_connections=OLLAMA_MAX_CONNECTIONS,
+        max_keepalive_connections=OLLAMA_MAX_CONNECTIONS
     )
+)
 
-def get_conversation_history(user_id, limit=5):
-    cursor.execute("""
-        SELECT user_message, bot_response FROM conversation
-        WHERE user_id = ?
-        ORDER BY timestamp DESC
-        LIMIT ?
-    """, (user_id, limit))
-    rows = cursor.fetchall()
-    history = []
-    for usr_msg, bot_msg in reversed(rows):
-        history.append({'role': 'user', 'content': usr_msg})
-        history.append({'role': 'assistant', 'content': bot_msg})
-    return history
-
-def add_or_update_user(user_id, username):
-    rank_cursor.execute("""
+def parse_weights(value):
+    # "chat_id:weight,chat_id:weight"
+    weights = {}
+    for item in filter(None, value.split(",")):
+        chat_id, weight = item.split(":")
+        weights[chat_id.strip()] = float(weight)
+    return weights
+
+LLM_WORKERS = int(os.getenv("LLM_WORKERS", str(2 * len(OLLAMA_HOSTS))))
+LLM_MAX_QUEUE = int(os.getenv("LLM_MAX_QUEUE", "100"))
+LLM_CHAT_WEIGHTS = parse_weights(os.getenv("LLM_CHAT_WEIGHTS", ""))
+llm_dispatcher = LLMDispatcher(workers=LLM_WORKERS, max_queue=LLM_MAX_QUEUE, chat_weights=LLM_CHAT_WEIGHTS)
+
+RESPONSE_CACHE_ENTRIES = int(os.getenv("RESPONSE_CACHE_ENTRIES", "1000"))
+RESPONSE_CACHE_BYTES = int(os.getenv("RESPONSE_CACHE_BYTES", str(8 * 1024 * 1024)))
+RESPONSE_CACHE_TTL = float(os.getenv("RESPONSE_CACHE_TTL", "3600"))
+RESPONSE_CACHE_PERSIST = os.getenv("RESPONSE_CACHE_PERSIST", "0") == "1"
+response_cache = ResponseCache(
+    max_entries=RESPONSE_CACHE_ENTRIES,
+    max_bytes=RESPONSE_CACHE_BYTES,
+    ttl=RESPONSE_CACHE_TTL,
+    db=conversation_db if RESPONSE_CACHE_PERSIST else None
+)
+
+SEMANTIC_CACHE = os.getenv("SEMANTIC_CACHE", "0") == "1"
+SEMANTIC_CACHE_PATH = "semantic_cache.npy"
+SEMANTIC_CACHE_MODEL = os.getenv("SEMANTIC_CACHE_MODEL", "all-minilm")
+SEMANTIC_CACHE_THRESHOLD = float(os.getenv("SEMANTIC_CACHE_THRESHOLD", "0.92"))
+SEMANTIC_CACHE_SIZE = int(os.getenv("SEMANTIC_CACHE_SIZE", "100000"))
+SEMANTIC_CACHE_MAX_CHARS = int(os.getenv("SEMANTIC_CACHE_MAX_CHARS", "200"))
+semantic_cache = None
+if SEMANTIC_CACHE:
+    if SemanticCache.available:
+        semantic_cache = SemanticCache(
+            client, conversation_db, SEMANTIC_CACHE_PATH,
+            embed_model=SEMANTIC_CACHE_MODEL,
+            threshold=SEMANTIC_CACHE_THRESHOLD,
+            capacity=SEMANTIC_CACHE_SIZE
+        )
+    else:
+        logging.warning("SEMANTIC_CACHE needs numpy, the semantic cache is disabled.")
+
+# Long-term memory: every saved turn is embedded in the background and
+# the few past turns most similar to a new message are added to its prompt
+MEMORY = os.getenv("MEMORY", "0") == "1"
+MEMORY_DIR = os.path.join(os.path.dirname(DB_PATH), "memory")
+MEMORY_EMBED_MODEL = os.getenv("MEMORY_EMBED_MODEL", SEMANTIC_CACHE_MODEL)
+MEMORY_TOP_K = int(os.getenv("MEMORY_TOP_K", "3"))
+MEMORY_MIN_SCORE = float(os.getenv("MEMORY_MIN_SCORE", "0.4"))
+MEMORY_TOKEN_BUDGET = int(os.getenv("MEMORY_TOKEN_BUDGET", "300"))
+MEMORY_MAX_OPEN = int(os.getenv("MEMORY_MAX_OPEN", "256"))
+memory_index = None
+if MEMORY:
+    if MemoryIndex.available:
+        memory_index = MemoryIndex(
+            client, conversation_db, MEMORY_DIR,
+            embed_model=MEMORY_EMBED_MODEL,
+            max_open=MEMORY_MAX_OPEN
+        )
+    else:
+        logging.warning("MEMORY needs numpy, long-term memory is disabled.")
+
+inflight_generations = SingleFlight()
+
+CACHE_STATS_INTERVAL = float(os.getenv("CACHE_STATS_INTERVAL", "600"))
+
+# deepseek-r1's <think> blocks are never sent, stored in bot_response or
+# replayed; THINK_ARCHIVE=1 keeps them zlib-compressed in their own column
+THINK_ARCHIVE = os.getenv("THINK_ARCHIVE", "0") == "1"
+
+async def save_conversation(user_id, user_message, bot_response, reasoning=None):
+    reasoning = compress_reasoning(reasoning) if THINK_ARCHIVE else None
+    turn_id = await conversation_db.execute("""
+        INSERT INTO conversation (user_id, user_message, bot_response, reasoning)
+        VALUES (?, ?, ?, ?)
+    """, (user_id, user_message, bot_response, reasoning))
+    history_cache.append(user_id, turn_id, user_message, bot_response)
+    if memory_index is not None:
+        task = asyncio.get_running_loop().create_task(remember(user_id, turn_id, user_message, bot_response))
+        background_tasks.add(task)
+        task.add_done_callback(background_tasks.discard)
+
+async def remember(user_id, turn_id, user_message, bot_response):
+    try:
+        await memory_index.add(user_id, turn_id, f"{user_message}\n{bot_response}")
+    except Exception as e:
+        logging.error(f"Error adding turn {turn_id} to memory: {e}")
+
+async def recall(user_message, user_id, exclude):
+    # Past turns relevant to user_message, oldest first, within MEMORY_TOKEN_BUDGET
+    try:
+        vector = await memory_index.embed(user_message)
+        turn_ids = await memory_index.search(user_id, vector, MEMORY_TOP_K, MEMORY_MIN_SCORE, exclude)
+    except Exception as e:
+        logging.error(f"Error searching memory: {e}")
+        return []
+    if not turn_ids:
+        return []
+    rows = await conversation_db.fetchall(f"""
+        SELECT id, user_message, bot_response FROM conversation
+        WHERE id IN ({",".join("?" * len(turn_ids))})
+    """, turn_ids)
+    rows = {turn_id: (usr_msg, strip_reasoning(bot_msg)) for turn_id, usr_msg, bot_msg in rows}
+
+    # Best matches get the budget first
+    recalled = []
+    budget = MEMORY_TOKEN_BUDGET
+    for turn_id in turn_ids:
+        if turn_id not in rows:
+            continue
+        memory = f"Master: {rows[turn_id][0]}\nKisaragi: {rows[turn_id][1]}"
+        if estimate_tokens(memory) > budget:
+            continue
+        budget -= estimate_tokens(memory)
+        recalled.append((turn_id, memory))
+    return [memory for _, memory in sorted(recalled)]
+
+async def get_recent_turns(user_id, limit=HISTORY_TURNS):
+    # (id, user message, assistant message) for the newest turns, oldest first
+    turns = history_cache.get(user_id, limit)
+    if turns is not None:
+        return turns
+
+    version = history_cache.begin_load(user_id)
+    try:
+        rows = await conversation_db.fetchall("""
+            SELECT id, user_message, bot_response FROM conversation
+            WHERE user_id = ?
+            ORDER BY id DESC
+            LIMIT ?
+        """, (user_id, max(limit, HISTORY_TURNS)))
+    except BaseException:
+        history_cache.abort_load(user_id)
+        raise
+    # Rows saved before reasoning was stripped may still carry <think> blocks
+    rows = [(turn_id, usr_msg, strip_reasoning(bot_msg)) for turn_id, usr_msg, bot_msg in reversed(rows)]
+    history_cache.load(user_id, rows, version)
+    return [
+        (turn_id, {'role': 'user', 'content': usr_msg}, {'role': 'assistant', 'content': bot_msg})
+        for turn_id, usr_msg, bot_msg in rows[len(rows) - min(limit, len(rows)):]
+    ]
+
+async def add_or_update_user(user_id, username):
+    leaderboard_cache.add(user_id, username, 0)
+    await rank_db.execute("""
         INSERT INTO user_ranks (user_id, username, xp, level)
         VALUES (?, ?, 0, 1)
         ON CONFLICT(user_id) DO NOTHING
     """, (user_id, username))
-    rank_conn.commit()
-
-def update_xp(user_id, username):
-    add_or_update_user(user_id, username)
-    rank_cursor.execute("""
-        SELECT xp, level FROM user_ranks WHERE user_id = ?
-    """, (user_id,))
-    result = rank_cursor.fetchone()
-    if result:
-        xp, level = result
-        xp += 10  # XP gain
-        if xp >= 100:  # Level-up threshold
-            xp = 0
-            level += 1
-        rank_cursor.execute("""
-            UPDATE user_ranks SET xp = ?, level = ? WHERE user_id = ?
-        """, (xp, level, user_id))
-        rank_conn.commit()
-
-def get_user_rank(user_id):
-    rank_cursor.execute("""
-        SELECT username, xp, level FROM user_ranks WHERE user_id = ?
-    """, (user_id,))
-    result = rank_cursor.fetchone()
+
+def update_xp(user_id, username, chat_id=None):
+    # Buffered in memory and written to user_ranks/chat_ranks in batches
+    xp_engine.add(user_id, username, chat_id)
+    leaderboard_cache.add(user_id, username, XP_PER_MESSAGE)
+    if chat_id is not None:
+        chat_leaderboards[chat_id].add(user_id, username, XP_PER_MESSAGE)
+
+def get_board(chat_id=None):
+    if chat_id is None:
+        return leaderboard_cache
+    return chat_leaderboards.get(chat_id)
+
+def get_user_rank(user_id, chat_id=None):
+    board = get_board(chat_id)
+    result = board.score(user_id) if board else None
     if result:
-        username, xp, level = result
-        return f"{username}, you are level {level} with {xp}/100 XP."
+        username, level, xp = result
+        scope = "in this chat" if chat_id else "overall"
+        return f"{username}, you are level {level} with {xp}/100 XP (#{board.position(user_id)} {scope})."
     else:
         return "You have no rank yet. Start messaging to gain XP!"
 
-def get_leaderboard(limit=10):
-    rank_cursor.execute("""
+async def get_leaderboard(limit=LEADERBOARD_SIZE):
+    return await rank_db.fetchall("""
         SELECT username, level, xp FROM user_ranks
         ORDER BY level DESC, xp DESC
         LIMIT ?
     """, (limit,))
-    return rank_cursor.fetchall()
 
-async def query_model(user_message: str, user_id: str) -> str:
-    history = get_conversation_history(user_id)  # Retrieve user conversation history
+async def load_leaderboard():
+    leaderboard_cache.load(await rank_db.fetchall("""
+        SELECT user_id, username, level, xp FROM user_ranks
+    """))
+    rows = defaultdict(list)
+    for chat_id, user_id, username, level, xp in await rank_db.fetchall("""
+        SELECT chat_id, user_id, username, level, xp FROM chat_ranks
+    """):
+        rows[chat_id].append((user_id, username, level, xp))
+    chat_leaderboards.clear()
+    for chat_id, chat_rows in rows.items():
+        chat_leaderboards[chat_id].load(chat_rows)
+
+    # Cross-check the rebuilt board against the (level, xp) index; ties may
+    # be ordered differently, so only the scores are compared
+    expected = [(level, xp) for _, level, xp in await get_leaderboard()]
+    actual = [(level, xp) for _, level, xp in leaderboard_cache.top(LEADERBOARD_SIZE)]
+    if expected != actual:
+        logging.error(f"Leaderboard mismatch after rebuild: expected {expected}, got {actual}")
+
+MODEL_NAME = "deepseek-r1:8b"
+SYSTEM_PROMPT = "You are Kisaragi, a playful fox-girl maid who loves helping Master with tasks. Stay polite, charming, and maintain your personality. You do not need to show me your thought process, just present the final result."
+ERROR_RESPONSE = "Sorry, I encountered an error processing your request."
+
+def keep_alive_value(value):
+    # Ollama takes durations like "30m", or a number of seconds (-1 = forever)
+    try:
+        return int(value)
+    except ValueError:
+        return value.strip()
+
+def parse_keep_alive(value):
+    # "model=duration,model=duration"
+    keep_alive = {}
+    for item in filter(None, value.split(",")):
+        model, duration = item.rsplit("=", 1)
+        keep_alive[model.strip()] = keep_alive_value(duration)
+    return keep_alive
+
+# An optional small model for greetings and chit-chat; see ModelRouter for
+# which messages it gets
+FAST_MODEL = os.getenv("FAST_MODEL", "")
+MODEL_TIERS = {"deep": MODEL_NAME, "fast": FAST_MODEL} if FAST_MODEL else {"deep": MODEL_NAME}
+
+def parse_chat_tiers(value):
+    # "chat_id:tier,chat_id:tier"
+    tiers = {}
+    for item in filter(None, value.split(",")):
+        chat_id, tier = item.rsplit(":", 1)
+        tiers[chat_id.strip()] = tier.strip()
+    return tiers
+
+ROUTER_CHAT_TIERS = parse_chat_tiers(os.getenv("ROUTER_CHAT_TIERS", ""))
+ROUTER_FAST_MAX_CHARS = int(os.getenv("ROUTER_FAST_MAX_CHARS", "80"))
+ROUTER_QUESTION_MAX_CHARS = int(os.getenv("ROUTER_QUESTION_MAX_CHARS", "24"))
+ROUTER_FAST_MAX_HISTORY_TOKENS = int(os.getenv("ROUTER_FAST_MAX_HISTORY_TOKENS", "1000"))
+MODEL_STATS_INTERVAL = float(os.getenv("MODEL_STATS_INTERVAL", "600"))
+model_router = ModelRouter(
+    MODEL_TIERS,
+    chat_tiers=ROUTER_CHAT_TIERS,
+    fast_max_chars=ROUTER_FAST_MAX_CHARS,
+    question_max_chars=ROUTER_QUESTION_MAX_CHARS,
+    fast_max_history_tokens=ROUTER_FAST_MAX_HISTORY_TOKENS
+)
+
+OLLAMA_MODELS = [m.strip() for m in os.getenv("OLLAMA_MODELS", ",".join(MODEL_TIERS.values())).split(",") if m.strip()]
+OLLAMA_KEEP_ALIVE = keep_alive_value(os.getenv("OLLAMA_KEEP_ALIVE", "30m"))
+OLLAMA_MODEL_KEEP_ALIVE = parse_keep_alive(os.getenv("OLLAMA_MODEL_KEEP_ALIVE", ""))
+OLLAMA_KEEP_WARM_INTERVAL = float(os.getenv("OLLAMA_KEEP_WARM_INTERVAL", "240"))
+model_manager = ModelManager(client, OLLAMA_MODELS, keep_alive=OLLAMA_MODEL_KEEP_ALIVE, default_keep_alive=OLLAMA_KEEP_ALIVE)
+
+TIMEOUT_RESPONSE = "Sorry Master, that took me too long to think about. Could you ask again? (；￣Д￣)"
+CANCELLED_RESPONSE = "(never mind~)"
+
+# "supersede": a new message cancels the user's unfinished reply
+# "queue": it waits for that reply and is answered afterwards
+GENERATION_POLICY = os.getenv("GENERATION_POLICY", "supersede")
+# Give up slightly before the HTTP client's own 60 s timeout would fire
+GENERATION_TIMEOUT = float(os.getenv("GENERATION_TIMEOUT", "55"))
+generations = {}  # (chat_id, user_id) -> set of reply tasks
+# Reply tasks whose reply has gone out; a new message waits for them to
+# save it instead of superseding them
+replied = set()
+
+# Messages sent in quick succession are answered as one turn: a turn waits
+# until the user pauses for DEBOUNCE_WINDOW seconds, but no longer than
+# DEBOUNCE_MAX_WAIT after the first message of the burst
+DEBOUNCE_WINDOW = float(os.getenv("DEBOUNCE_WINDOW", "1.0"))
+DEBOUNCE_MAX_WAIT = float(os.getenv("DEBOUNCE_MAX_WAIT", "4.0"))
+pending_messages = {}  # (chat_id, user_id) -> [(arrived, text, tier)] not yet answered
+collecting = set()  # Reply tasks that haven't picked up their messages yet
+
+BUSY_RESPONSE = "I'm a little overwhelmed right now, Master! Please try again in a moment. (>_<)"
+
+STREAM_RESPONSES = os.getenv("STREAM_RESPONSES", "1") == "1"
+# Telegram allows roughly one edit per second in private chats and
+# 20 messages per minute in groups, so start there and back off on RetryAfter
+STREAM_EDIT_INTERVAL = float(os.getenv("STREAM_EDIT_INTERVAL", "1.0"))
+STREAM_GROUP_EDIT_INTERVAL = float(os.getenv("STREAM_GROUP_EDIT_INTERVAL", "3.0"))
+STREAM_MAX_EDIT_INTERVAL = float(os.getenv("STREAM_MAX_EDIT_INTERVAL", "10.0"))
+STREAM_PLACEHOLDER = "..."
+
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "1500"))
+SUMMARY_MIN_TURNS = int(os.getenv("SUMMARY_MIN_TURNS", "4"))
+SUMMARY_MAX_TURNS = int(os.getenv("SUMMARY_MAX_TURNS", "50"))
+SUMMARY_MAX_TOKENS = int(os.getenv("SUMMARY_MAX_TOKENS", "256"))
+SUMMARY_PROMPT = "You summarize conversations between Master and Kisaragi. Merge the existing summary with the new conversation into one short paragraph. Keep facts about Master, their requests and anything Kisaragi promised. Reply with the summary only."
+summary_store = SummaryStore(conversation_db, max_users=HISTORY_CACHE_USERS)
+pending_summaries = set()
+
+def parse_thresholds(value, cast=float):
+    # "trim,downgrade,reject"
+    return tuple(cast(threshold) for threshold in value.split(","))
+
+# Under pressure talk turns first get shorter replies and less history,
+# then the fast model, then an immediate busy reply. Pressure is the LLM
+# queue depth or the p95 time turns waited in the queue for a worker over
+# the last SHED_WINDOW seconds, whichever is worse. Generation time isn't
+# counted: a slow model is not a backlog.
+SHED_QUEUE_DEPTHS = parse_thresholds(
+    os.getenv("SHED_QUEUE_DEPTHS", f"{2 * LLM_WORKERS},{4 * LLM_WORKERS},{8 * LLM_WORKERS}"), int
+)
+SHED_LATENCIES = parse_thresholds(os.getenv("SHED_LATENCIES", "20,30,45"))
+SHED_WINDOW = float(os.getenv("SHED_WINDOW", "60"))
+SHED_NUM_PREDICT = int(os.getenv("SHED_NUM_PREDICT", "256"))
+SHED_CONTEXT_TOKEN_BUDGET = int(os.getenv("SHED_CONTEXT_TOKEN_BUDGET", str(CONTEXT_TOKEN_BUDGET // 3)))
+load_shedder = LoadShedder(depth_thresholds=SHED_QUEUE_DEPTHS, latency_thresholds=SHED_LATENCIES, window=SHED_WINDOW)
+
+async def summarize_history(user_id, before_id):
+    # Fold the unsummarized turns older than before_id into the user's
+    # summary, oldest first; a longer backlog is left to the next pass so
+    # no turn is skipped over
+    summary, last_id = await summary_store.get(user_id)
+    rows = await conversation_db.fetchall("""
+        SELECT id, user_message, bot_response FROM conversation
+        WHERE user_id = ? AND id > ? AND id < ?
+        ORDER BY id ASC
+        LIMIT ?
+    """, (user_id, last_id, before_id, SUMMARY_MAX_TURNS))
+    if len(rows) < SUMMARY_MIN_TURNS:
+        return
+    transcript = "\n".join(f"Master: {usr_msg}\nKisaragi: {strip_reasoning(bot_msg)}" for _, usr_msg, bot_msg in rows)
+    response: ChatResponse = await client.chat(
+        model=MODEL_NAME,
+        messages=[
+            {"role": "system", "content": SUMMARY_PROMPT},
+            {"role": "user", "content": f"Existing summary:\n{summary or '(none)'}\n\nNew conversation:\n{transcript}"}
+        ],
+        options={"num_predict": SUMMARY_MAX_TOKENS},
+        keep_alive=model_manager.keep_alive_for(MODEL_NAME),
+        user=user_id
+    )
+    await summary_store.set(user_id, strip_reasoning(response.message.content), rows[-1][0])
 
+def schedule_summary(user_id, before_id):
+    # Summaries wait for quieter times
+    if user_id in pending_summaries or load_shedder.level(llm_dispatcher.queued()):
+        return
+    try:
+        # Summaries share the Ollama workers as their own low-volume "chat"
+        future, _ = llm_dispatcher.submit("summaries", user_id, lambda: summarize_history(user_id, before_id))
+    except QueueFull:
+        return
+    pending_summaries.add(user_id)
+    future.add_done_callback(lambda _: pending_summaries.discard(user_id))
+
+async def build_messages(user_message, user_id, token_budget=CONTEXT_TOKEN_BUDGET, use_memory=True):
+    turns = await get_recent_turns(user_id)  # Retrieve user conversation history
+    summary, summarized_id = await summary_store.get(user_id)
+    memories = ""
+    if memory_index is not None and use_memory:
+        memories = "\n".join(await recall(user_message, user_id, {turn[0] for turn in turns}))
+    turns = [turn for turn in turns if turn[0] > summarized_id]
+
+    # Newest turns first until the token budget runs out; whatever falls out
+    # is folded into the rolling summary in the background
+    budget = token_budget - estimate_tokens(SYSTEM_PROMPT) - estimate_tokens(user_message)
+    if summary:
+        budget -= estimate_tokens(summary)
+    if memories:
+        budget -= estimate_tokens(memories)
+    kept = pack_turns(turns, budget)
+    if len(kept) < len(turns) or len(turns) == HISTORY_TURNS:
+        schedule_summary(user_id, kept[0][0] if kept else turns[-1][0] + 1)
+
+    messages = [{"role": "system", "content": SYSTEM_PROMPT}]
+    if summary:
+        messages.append({"role": "system", "content": f"Summary of your earlier conversation with Master: {summary}"})
+    if memories:
+        messages.append({"role": "system", "content": f"Earlier moments with Master that may be relevant:\n{memories}"})
+    for _, usr_msg, bot_msg in kept:
+        messages.append(usr_msg)
+        messages.append(bot_msg)
+    messages.append({"role": "user", "content": user_message})
+    return messages
+
+async def query_model(messages, user_id=None, model=MODEL_NAME, options=None):
+    # Returns (reply, reasoning, model that answered); user_id keeps a user
+    # on the same Ollama host
     try:
-        response = client.chat(
-            model="deepseek-r1:8b",
-            messages=[
-                {"role": "system", "content": "You are Kisaragi, a playful fox-girl maid who loves helping Master with tasks. Stay polite, charming, and maintain your personality. You do not need to show me your thought process, just present the final result."},
-                *history,
-                {"role": "user", "content": user_message}
-            ],
-            stream=False
+        response: ChatResponse = await client.chat(
+            model=model,
+            messages=messages,
+            stream=False,
+            options=options,
+            keep_alive=model_manager.keep_alive_for(model),
+            user=user_id,
+            hedge_model=MODEL_TIERS.get("fast")
         )
-        return response.message.content
+        think = ThinkFilter()
+        text = (think.feed(response.message.content) + think.flush()).strip()
+        return text or ERROR_RESPONSE, think.reasoning, response.model or model
 
     except Exception as e:
         logging.error(f"Error querying model: {e}")
-        return "Sorry, I encountered an error processing your request."
+        return ERROR_RESPONSE, "", model
+
+async def stream_model(messages, user_id=None, model=MODEL_NAME, options=None):
+    # Yields (content, model that answered); a hedge may answer with another
+    stream = await client.chat(
+        model=model,
+        messages=messages,
+        stream=True,
+        options=options,
+        keep_alive=model_manager.keep_alive_for(model),
+        user=user_id,
+        hedge_model=MODEL_TIERS.get("fast")
+    )
+    # Closing the generator closes the HTTP response, which makes Ollama
+    # stop generating
+    async with aclosing(stream):
+        async for part in stream:
+            if part.message.content:
+                yield part.message.content, part.model or model
+
+async def stream_reply(update: Update, messages, model=MODEL_NAME, options=None):
+    # Post a placeholder and grow it in place as tokens arrive
+    placeholder = await update.message.reply_text(STREAM_PLACEHOLDER)
+    if update.effective_chat.type == ChatType.PRIVATE:
+        interval = STREAM_EDIT_INTERVAL
+    else:
+        interval = STREAM_GROUP_EDIT_INTERVAL
+
+    think = ThinkFilter()
+    text = ""
+    shown = ""
+    complete = False
+    answered = model
+    # The first chunk is shown right away; only later edits are throttled
+    last_edit = float("-inf")
+    try:
+        async with aclosing(stream_model(messages, str(update.effective_user.id), model, options)) as chunks:
+            async for chunk, answered in chunks:
+                text += think.feed(chunk)
+                now = time.monotonic()
+                if now - last_edit < interval or not text.strip() or text == shown:
+                    continue
+                last_edit = now
+                try:
+                    await placeholder.edit_text(text[:MAX_MESSAGE_LENGTH])
+                    shown = text
+                except RetryAfter as e:
+                    interval = min(max(interval * 2, e.retry_after), STREAM_MAX_EDIT_INTERVAL)
+                    last_edit = now + e.retry_after
+                except BadRequest:
+                    pass
+        text = (text + think.flush()).strip()
+        complete = bool(text)
+    except asyncio.CancelledError:
+        # Leave what was said so far instead of a dangling placeholder
+        try:
+            await placeholder.edit_text(f"{text.strip()} {CANCELLED_RESPONSE}".strip()[:MAX_MESSAGE_LENGTH])
+        except Exception:
+            pass
+        raise
+    except Exception as e:
+        logging.error(f"Error streaming model: {e}")
+        text = text.strip()
+
+    # The final edit carries the same text that gets saved to the conversation
+    text = text or ERROR_RESPONSE
+    try:
+        await placeholder.edit_text(f"**{text}**"[:MAX_MESSAGE_LENGTH], parse_mode="markdown")
+    except RetryAfter as e:
+        await asyncio.sleep(e.retry_after)
+        await placeholder.edit_text(text[:MAX_MESSAGE_LENGTH])
+    except BadRequest:
+        if text != shown:
+            await placeholder.edit_text(text[:MAX_MESSAGE_LENGTH])
+    return text, think.reasoning, complete, answered
+
+async def generate_reply(update: Update, messages, tier="deep", semantic_vector=None, options=None, turn=None):
+    # Returns (reply, reasoning); turn is the reply task, marked as replied
+    # once the reply is out
+    model = model_router.model(tier)
+    started = time.monotonic()
+    if STREAM_RESPONSES:
+        bot_response, reasoning, complete, answered = await stream_reply(update, messages, model, options)
+    else:
+        bot_response, reasoning, answered = await query_model(messages, str(update.effective_user.id), model, options)
+        complete = bot_response != ERROR_RESPONSE
+        await update.message.reply_text(f"**{bot_response}**", parse_mode="markdown")
+    if turn is not None:
+        replied.add(turn)
+    # A hedge may have been answered by the fast model instead
+    if complete:
+        model_router.record(model_router.tier_of(answered) or tier, time.monotonic() - started)
+    # Replies cut short by load shedding aren't worth serving again
+    if complete and options is None:
+        response_cache.put(cache_key(answered, messages), bot_response)
+        if semantic_vector is not None:
+            semantic_cache.add(semantic_vector, answered, bot_response)
+    return bot_response, reasoning
+
+async def lookup_semantic_cache(user_message, messages, model=MODEL_NAME):
+    # Only short prompts without history are answered from similar ones
+    if semantic_cache is None or len(messages) > 2 or len(user_message) > SEMANTIC_CACHE_MAX_CHARS:
+        return None, None
+    try:
+        vector = await semantic_cache.embed(user_message)
+    except Exception as e:
+        logging.error(f"Error embedding message: {e}")
+        return None, None
+    return vector, await semantic_cache.lookup(vector, model)
+
+async def dispatch_reply(update: Update, messages, tier="deep", semantic_vector=None, options=None, turn=None):
+    # The timeout covers the generation itself, not the time spent queued;
+    # the time spent queued is what the load shedder watches
+    reply, position = llm_dispatcher.submit(
+        str(update.effective_chat.id), str(update.effective_user.id),
+        lambda: asyncio.wait_for(generate_reply(update, messages, tier, semantic_vector, options, turn), GENERATION_TIMEOUT),
+        on_start=load_shedder.record
+    )
+    if position:
+        await update.message.reply_text(f"You're #{position} in line, Master! I'll be right with you~ (｡•̀ᴗ-)✧")
+    return await reply
+
+def chat_scope(update: Update):
+    # Groups get their own ranking, private chats use the global one
+    if update.effective_chat.type == ChatType.PRIVATE:
+        return None
+    return str(update.effective_chat.id)
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = str(update.effective_user.id)
     username = update.effective_user.username or "Anonymous"
 
     # Add or update the user in the rank database
-    add_or_update_user(user_id, username)
+    await add_or_update_user(user_id, username)
 
     # Send a welcome message
     welcome_message = (
@@ -178,18 +717,130 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     user_id = str(update.effective_user.id)
     username = update.effective_user.username or "Anonymous"
-    user_message = update.message.text
 
     # Update XP whenever a message is processed
-    update_xp(user_id, username)
+    update_xp(user_id, username, chat_scope(update))
 
     if user_id in active_talk_sessions.get(str(update.effective_chat.id), set()):
-        # Indicate the bot is typing
-        await context.bot.send_chat_action(chat_id=update.effective_chat.id, action=ChatAction.TYPING)
+        tier, text = ModelRouter.split_prefix(update.message.text)
+        if not text:
+            return
+
+        # The reply runs as its own task so a follow-up message or /endtalk
+        # from the same user isn't stuck behind it; the application's task
+        # passes its errors to the error handlers
+        key = (str(update.effective_chat.id), user_id)
+        pending_messages.setdefault(key, []).append((time.monotonic(), text, tier))
+        earlier = []
+        for task in generations.get(key, ()):
+            if task.done():
+                continue
+            # A turn still collecting messages is restarted to include this one
+            if task in collecting or (GENERATION_POLICY == "supersede" and task not in replied):
+                task.cancel()
+            else:
+                earlier.append(task)
+        task = context.application.create_task(talk_turn(update, context, key, earlier), update=update)
+        generations.setdefault(key, set()).add(task)
+        collecting.add(task)
+        task.add_done_callback(lambda task: forget_generation(key, task))
+
+def forget_generation(key, task):
+    collecting.discard(task)
+    replied.discard(task)
+    tasks = generations.get(key)
+    if tasks is not None:
+        tasks.discard(task)
+        if not tasks:
+            del generations[key]
+
+def cancel_generations(chat_id, user_id):
+    pending_messages.pop((chat_id, user_id), None)
+    tasks = generations.get((chat_id, user_id), ())
+    for task in tasks:
+        task.cancel()
+    return bool(tasks)
+
+async def talk_turn(update: Update, context: ContextTypes.DEFAULT_TYPE, key, earlier):
+    # Queued turns wait for the user's previous replies so history stays in order
+    if earlier:
+        await asyncio.wait(earlier)
+
+    pending = pending_messages.get(key, [])
+    if pending:
+        delay = min(pending[-1][0] + DEBOUNCE_WINDOW, pending[0][0] + DEBOUNCE_MAX_WAIT) - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+    collecting.discard(asyncio.current_task())
+    burst = list(pending)
+    if not burst:
+        return
+
+    # One /think in the burst is enough to send all of it to the deep tier
+    tier = "deep" if any(tier for _, _, tier in burst) else None
+    cancelled = False
+    try:
+        await answer(update, context, "\n".join(text for _, text, _ in burst), tier)
+    except asyncio.CancelledError:
+        cancelled = True
+        raise
+    finally:
+        # A cancelled turn leaves its messages to be answered with the next
+        # one; a failed one doesn't, or they'd be sent again
+        if not cancelled:
+            del pending[:len(burst)]
+            if not pending and pending_messages.get(key) is pending:
+                del pending_messages[key]
+
+async def answer(update: Update, context: ContextTypes.DEFAULT_TYPE, user_message, tier=None):
+    user_id = str(update.effective_user.id)
+    turn = asyncio.current_task()
+
+    # Indicate the bot is typing
+    await context.bot.send_chat_action(chat_id=update.effective_chat.id, action=ChatAction.TYPING)
 
-        bot_response = await query_model(user_message, user_id)
-        await save_conversation_async(user_id, user_message, bot_response)
+    level = load_shedder.admit(llm_dispatcher.queued())
+    if level >= TRIM:
+        messages = await build_messages(user_message, user_id, SHED_CONTEXT_TOKEN_BUDGET, use_memory=False)
+    else:
+        messages = await build_messages(user_message, user_id)
+    history_tokens = sum(estimate_tokens(message["content"]) for message in messages[1:-1])
+    tier = model_router.route(user_message, history_tokens, str(update.effective_chat.id), tier)
+    if level >= DOWNGRADE and "fast" in MODEL_TIERS:
+        tier = "fast"
+    options = {"num_predict": SHED_NUM_PREDICT} if level >= TRIM else None
+    model = model_router.model(tier)
+    key = cache_key(model, messages)
+    bot_response = response_cache.get(key)
+    semantic_vector = None
+    if bot_response is None:
+        semantic_vector, bot_response = await lookup_semantic_cache(user_message, messages, model)
+    if bot_response is not None:
+        await update.message.reply_text(f"**{bot_response}**", parse_mode="markdown")
+        replied.add(turn)
+        await asyncio.shield(save_conversation(user_id, user_message, bot_response))
+        return
+
+    # Identical prompts already being generated share that generation
+    leader = key not in inflight_generations
+    if leader and level >= REJECT:
+        await update.message.reply_text(BUSY_RESPONSE)
+        return
+    try:
+        bot_response, reasoning = await inflight_generations.do(
+            key, lambda: dispatch_reply(update, messages, tier, semantic_vector, options, turn)
+        )
+    except QueueFull:
+        await update.message.reply_text(BUSY_RESPONSE)
+        return
+    except asyncio.TimeoutError:
+        await update.message.reply_text(TIMEOUT_RESPONSE)
+        return
+    if not leader:
         await update.message.reply_text(f"**{bot_response}**", parse_mode="markdown")
+        replied.add(turn)
+    # Once the reply is out the turn has to be saved, even on /endtalk
+    await asyncio.shield(save_conversation(user_id, user_message, bot_response, reasoning))
 
 async def talk(update: Update, context: ContextTypes.DEFAULT_TYPE):
     session_id = str(update.effective_chat.id)
@@ -212,6 +863,7 @@ async def endtalk(update: Update, context: ContextTypes.DEFAULT_TYPE):
         active_talk_sessions[session_id].remove(user_id)
         if not active_talk_sessions[session_id]:
             del active_talk_sessions[session_id]
+        cancel_generations(session_id, user_id)
 
         await context.bot.send_message(
             chat_id=update.effective_chat.id,
@@ -225,11 +877,12 @@ async def endtalk(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def rank(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = str(update.effective_user.id)
-    rank_info = get_user_rank(user_id)
+    rank_info = get_user_rank(user_id, chat_scope(update))
     await update.message.reply_text(rank_info, parse_mode="markdown")
 
 async def leaderboard(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    leaderboard_data = get_leaderboard()
+    board = get_board(chat_scope(update))
+    leaderboard_data = board.top(LEADERBOARD_SIZE) if board else []
     if leaderboard_data:
         message = "🏆 Leaderboard 🏆\n"
         for rank, (username, level, xp) in enumerate(leaderboard_data, start=1):
@@ -238,17 +891,99 @@ async def leaderboard(update: Update, context: ContextTypes.DEFAULT_TYPE):
     else:
         await update.message.reply_text("No leaderboard data available yet!")
 
+background_tasks = set()
+
+def run_repeating(application, callback, interval, name):
+    # PTB's JobQueue needs the job-queue extra (APScheduler); fall back to a
+    # plain asyncio loop when it isn't installed
+    if application.job_queue is not None:
+        application.job_queue.run_repeating(callback, interval=interval, first=interval, name=name)
+        return
+
+    async def repeat():
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await callback(None)
+            except Exception as e:
+                logging.error(f"Error in {name}: {e}")
+
+    background_tasks.add(asyncio.get_running_loop().create_task(repeat(), name=name))
+
+async def log_model_stats(context):
+    for tier, stats in model_router.stats().items():
+        logging.info(
+            f"Model tier {tier} ({model_router.model(tier)}): {stats['requests']} replies, "
+            f"p50 {stats['p50']:.1f}s, p95 {stats['p95']:.1f}s"
+        )
+    logging.info(f"Ollama backends: {client.stats()}")
+    logging.info(f"Talk admission: {dict(load_shedder.decisions)}, p95 wait {load_shedder.latency():.1f}s")
+
+async def log_cache_stats(context):
+    logging.info(f"Response cache: {response_cache.stats()}")
+    if semantic_cache:
+        logging.info(f"Semantic cache: {semantic_cache.stats()}")
+    logging.info(f"History cache: {history_cache.stats()}")
+    logging.info(f"Coalesced generations: {inflight_generations.stats()}")
+
+async def storage_maintenance(context):
+    for db in (conversation_db, rank_db):
+        await db.checkpoint()
+        await db.optimize()
+    if RESPONSE_CACHE_PERSIST:
+        await response_cache.prune()
+
+async def post_init(application):
+    await load_leaderboard()
+    if RESPONSE_CACHE_PERSIST:
+        await response_cache.load()
+    if semantic_cache:
+        await semantic_cache.load()
+    xp_engine.start()
+    llm_dispatcher.start()
+    # Load the model in the background so polling isn't held up by it
+    background_tasks.add(asyncio.get_running_loop().create_task(model_manager.preload()))
+    run_repeating(application, model_manager.keep_warm, OLLAMA_KEEP_WARM_INTERVAL, "keep_warm")
+    run_repeating(application, client.probe, OLLAMA_PROBE_INTERVAL, "probe_ollama")
+    run_repeating(application, log_model_stats, MODEL_STATS_INTERVAL, "model_stats")
+    run_repeating(application, log_cache_stats, CACHE_STATS_INTERVAL, "cache_stats")
+    run_repeating(application, storage_maintenance, SQLITE_MAINTENANCE_INTERVAL, "storage_maintenance")
+
+async def post_shutdown(application):
+    for task in background_tasks:
+        task.cancel()
+    for tasks in list(generations.values()):
+        for task in tasks:
+            task.cancel()
+    await llm_dispatcher.stop()
+    await xp_engine.stop()
+    if semantic_cache:
+        semantic_cache.flush()
+    if memory_index:
+        memory_index.flush()
+    await client.close()
+
 if __name__ == '__main__':
     try:
-        application = ApplicationBuilder().token(TOKEN).build()
+        application = (
+            ApplicationBuilder()
+            .token(TOKEN)
+            .concurrent_updates(PerUserUpdateProcessor(MAX_CONCURRENT_UPDATES))
+            .post_init(post_init)
+            .post_shutdown(post_shutdown)
+            .build()
+        )
 
         application.add_handler(CommandHandler('start', start))  # Start command
         application.add_handler(CommandHandler('talk', talk))
         application.add_handler(CommandHandler('endtalk', endtalk))
         application.add_handler(CommandHandler('leaderboard', leaderboard))
         application.add_handler(CommandHandler('rank', rank))  # Rank command
+        application.add_handler(CommandHandler('think', handle_message))  # Talk message for the deep model
         application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
 
         application.run_polling()
     finally:
-        executor.shutdown(wait=True)
+        xp_engine.flush_sync()
+        conversation_db.close()
+        rank_db.close()
@@ -0,0 +1,77 @@
+import re
+import zlib
+
+THINK_OPEN = "<think>"
+THINK_CLOSE = "</think>"
+THINK_BLOCK = re.compile(r"<think>.*?(?:</think>|$)", re.DOTALL)
+
+
+def strip_reasoning(text):
+    return THINK_BLOCK.sub("", text).strip()
+
+
+def compress_reasoning(reasoning):
+    return zlib.compress(reasoning.encode()) if reasoning else None
+
+
+def decompress_reasoning(blob):
+    return zlib.decompress(blob).decode() if blob else ""
+
+
+def _partial_tag(text, tag):
+    # Length of the longest suffix of text that is a prefix of tag
+    for size in range(min(len(tag) - 1, len(text)), 0, -1):
+        if text.endswith(tag[:size]):
+            return size
+    return 0
+
+
+class ThinkFilter:
+    """Incrementally removes ``<think>...</think>`` blocks from a stream.
+
+    :meth:`feed` returns the visible part of each chunk. A tag split across
+    chunks is held back until the next chunk shows whether it really is a
+    tag, so nothing inside a reasoning block ever leaks out. The removed
+    reasoning is collected in :attr:`reasoning`.
+    """
+
+    def __init__(self):
+        self.inside = False
+        self.reasoning = ""
+        self._pending = ""
+        self._started = False
+
+    def feed(self, chunk):
+        text = self._pending + chunk
+        self._pending = ""
+        visible = ""
+        while text:
+            tag = THINK_CLOSE if self.inside else THINK_OPEN
+            index = text.find(tag)
+            if index < 0:
+                keep = _partial_tag(text, tag)
+                body, self._pending = text[:len(text) - keep], text[len(text) - keep:]
+                text = ""
+            else:
+                body, text = text[:index], text[index + len(tag):]
+            if self.inside:
+                self.reasoning += body
+            else:
+                visible += body
+            if index >= 0:
+                self.inside = not self.inside
+        return self._visible(visible)
+
+    def flush(self):
+        text, self._pending = self._pending, ""
+        if self.inside:
+            self.reasoning += text
+            return ""
+        return self._visible(text)
+
+    def _visible(self, text):
+        # Drop the whitespace the model puts between reasoning and answer
+        if not self._started:
+            text = text.lstrip()
+            self._started = bool(text)
+        return text
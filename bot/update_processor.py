@@ -0,0 +1,67 @@
+import asyncio
+from typing import Any, Awaitable
+
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    """Processes updates from different users concurrently, up to
+    ``max_concurrent_updates`` at a time, while updates from the same user
+    run strictly one after another in arrival order.
+
+    The semaphore in :class:`BaseUpdateProcessor` is resized to
+    ``max_pending_updates`` so updates waiting behind an earlier update of
+    the same user don't occupy one of the running slots. It is built from
+    :attr:`max_concurrent_updates`, which is overridden, so it has to be
+    replaced after ``__init__``.
+    """
+
+    def __init__(self, max_concurrent_updates: int, max_pending_updates: int = None):
+        self._limit = max_concurrent_updates
+        max_pending_updates = max_pending_updates or max_concurrent_updates * 64
+        super().__init__(max_pending_updates)
+        self._semaphore = asyncio.BoundedSemaphore(max_pending_updates)
+        self._running = asyncio.BoundedSemaphore(max_concurrent_updates)
+        self._locks = {}
+        self._waiters = {}
+
+    @property
+    def max_concurrent_updates(self) -> int:
+        return self._limit
+
+    @staticmethod
+    def ordering_key(update: object):
+        if isinstance(update, Update):
+            if update.effective_user:
+                return ("user", update.effective_user.id)
+            if update.effective_chat:
+                return ("chat", update.effective_chat.id)
+        return None
+
+    async def do_process_update(self, update: object, coroutine: Awaitable[Any]) -> None:
+        key = self.ordering_key(update)
+        if key is None:
+            async with self._running:
+                await coroutine
+            return
+
+        lock = self._locks.get(key)
+        if lock is None:
+            lock = self._locks[key] = asyncio.Lock()
+        self._waiters[key] = self._waiters.get(key, 0) + 1
+        try:
+            async with lock:
+                async with self._running:
+                    await coroutine
+        finally:
+            self._waiters[key] -= 1
+            if not self._waiters[key]:
+                del self._waiters[key]
+                del self._locks[key]
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
@@ -0,0 +1,126 @@
+import asyncio
+import logging
+
+XP_PER_MESSAGE = 10
+LEVEL_XP = 100  # Level-up threshold
+
+# Applies a coalesced batch of XP to a user in one statement. SQLite evaluates
+# every SET expression against the old row, so level and xp both see the
+# pre-update xp.
+UPSERT_XP = f"""
+    INSERT INTO user_ranks (user_id, username, xp, level)
+    VALUES (:user_id, :username, :gain % {LEVEL_XP}, 1 + :gain / {LEVEL_XP})
+    ON CONFLICT(user_id) DO UPDATE SET
+        level = level + (xp + :gain) / {LEVEL_XP},
+        xp = (xp + :gain) % {LEVEL_XP}
+"""
+
+UPSERT_CHAT_XP = f"""
+    INSERT INTO chat_ranks (chat_id, user_id, username, xp, level)
+    VALUES (:chat_id, :user_id, :username, :gain % {LEVEL_XP}, 1 + :gain / {LEVEL_XP})
+    ON CONFLICT(chat_id, user_id) DO UPDATE SET
+        level = level + (xp + :gain) / {LEVEL_XP},
+        xp = (xp + :gain) % {LEVEL_XP}
+"""
+
+
+def apply_gain(level, xp, gain):
+    # Same arithmetic as UPSERT_XP, for in-memory mirrors of user_ranks
+    xp += gain
+    return level + xp // LEVEL_XP, xp % LEVEL_XP
+
+
+class XPAccumulator:
+    """Write-behind XP counter.
+
+    Message handlers call :meth:`add`, which only touches an in-memory dict.
+    Increments are coalesced per (chat, user) and written to ``user_ranks``
+    and ``chat_ranks`` in a single transaction when ``flush_size`` entries
+    are pending or every ``flush_interval`` seconds, whichever comes first.
+    """
+
+    def __init__(self, db, flush_interval=5.0, flush_size=500):
+        self.db = db
+        self.flush_interval = flush_interval
+        self.flush_size = flush_size
+        self._pending = {}
+        self._flush_lock = asyncio.Lock()
+        self._flush_task = None
+        self._timer_task = None
+
+    def add(self, user_id, username, chat_id=None, amount=XP_PER_MESSAGE):
+        key = (chat_id, user_id)
+        entry = self._pending.get(key)
+        if entry is None:
+            self._pending[key] = [username, amount]
+        else:
+            entry[1] += amount
+        if len(self._pending) >= self.flush_size and self._flush_task is None:
+            self._flush_task = asyncio.get_running_loop().create_task(self._size_flush())
+
+    def pending(self):
+        return len(self._pending)
+
+    async def _size_flush(self):
+        try:
+            await self.flush()
+        finally:
+            self._flush_task = None
+
+    async def flush(self):
+        async with self._flush_lock:
+            batch, self._pending = self._pending, {}
+            if not batch:
+                return
+            try:
+                await self.db.write(_write_batch, batch)
+            except Exception as e:
+                logging.error(f"Error flushing XP for {len(batch)} entries: {e}")
+                self._requeue(batch)
+
+    def flush_sync(self):
+        batch, self._pending = self._pending, {}
+        if batch:
+            self.db.submit(_write_batch, batch).result()
+
+    def _requeue(self, batch):
+        for key, (username, gain) in batch.items():
+            entry = self._pending.get(key)
+            if entry is None:
+                self._pending[key] = [username, gain]
+            else:
+                entry[1] += gain
+
+    async def _run_timer(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+    def start(self):
+        if self._timer_task is None:
+            self._timer_task = asyncio.get_running_loop().create_task(self._run_timer())
+
+    async def stop(self):
+        if self._timer_task is not None:
+            self._timer_task.cancel()
+            try:
+                await self._timer_task
+            except asyncio.CancelledError:
+                pass
+            self._timer_task = None
+        if self._flush_task is not None:
+            await self._flush_task
+        await self.flush()
+
+
+def _write_batch(conn, batch):
+    users = {}
+    chat_rows = []
+    for (chat_id, user_id), (username, gain) in batch.items():
+        row = users.setdefault(user_id, {"user_id": user_id, "username": username, "gain": 0})
+        row["gain"] += gain
+        if chat_id is not None:
+            chat_rows.append({"chat_id": chat_id, "user_id": user_id, "username": username, "gain": gain})
+    with conn:
+        conn.executemany(UPSERT_XP, list(users.values()))
+        conn.executemany(UPSERT_CHAT_XP, chat_rows)